@@ -46,7 +46,9 @@ from tensorflow.python.keras import backend as K
 import copy
 
 from threading import Thread, Lock
-from multiprocessing import Process, Pipe
+from multiprocessing import Process, Pipe, Semaphore
+from multiprocessing.sharedctypes import RawArray, RawValue
+import ctypes
 import time
 
 # gpus = tf.config.experimental.list_physical_devices('GPU')
@@ -85,6 +87,210 @@ class Environment(Process):
             self.child_conn.send([state, reward, done, info])
 
 
+class SharedMemoryEnvironment(Process):
+    # Same loop as Environment, but the worker reads its action from and writes its state, reward and done
+    # into NumPy arrays in shared memory, nothing is pickled. A step is one go/finished semaphore pair.
+    def __init__(self, env_idx, env_name, buffers, go, finished, visualize=False):
+        super(SharedMemoryEnvironment, self).__init__()
+        self.env = gym.make(env_name)
+        self.is_render = visualize
+        self.env_idx = env_idx
+        self.buffers = buffers
+        self.go = go
+        self.finished = finished
+
+    def run(self):
+        super(SharedMemoryEnvironment, self).run()
+        states, actions, rewards, dones, closing = SharedMemoryVecEnv.wrap(self.buffers)
+        idx = self.env_idx
+        states[idx] = self.env.reset()
+        self.finished.release()
+        while True:
+            self.go.acquire()
+            if closing.value:
+                break
+            state, reward, done, info = self.env.step(actions[idx])
+            if done:
+                state = self.env.reset()
+            states[idx] = state
+            rewards[idx] = reward
+            dones[idx] = done
+            self.finished.release()
+        self.env.close()
+
+
+class SharedMemoryVecEnv:
+    # num_worker environments in processes, stepped together. states is a (num_worker, state_size) view of
+    # shared memory, step() overwrites it in place (copy what has to be kept) and returns views of
+    # states, rewards and dones. Like Environment, a worker whose episode ended writes the reset state.
+    # A worker that dies or takes longer than timeout seconds for a step stops all of them with a RuntimeError.
+    def __init__(self, env_name, num_worker, state_size, action_size, visualize=False, timeout=60.0):
+        self.num_worker = num_worker
+        self.timeout = timeout
+        self.buffers = (
+            (RawArray(ctypes.c_float, num_worker * state_size), np.float32, (num_worker, state_size)),
+            (RawArray(ctypes.c_double, num_worker * action_size), np.float64, (num_worker, action_size)),
+            (RawArray(ctypes.c_double, num_worker), np.float64, (num_worker,)),
+            (RawArray(ctypes.c_bool, num_worker), np.bool_, (num_worker,)),
+        )
+        self.closing = RawValue(ctypes.c_bool, False)
+        self.states, self.actions, self.rewards, self.dones, _ = self.wrap(self.buffers + (self.closing,))
+        self.go = [Semaphore(0) for _ in range(num_worker)] # one per worker, a fast worker must not step twice
+        self.finished = Semaphore(0)
+        self.works = []
+        for idx in range(num_worker):
+            work = SharedMemoryEnvironment(idx, env_name, self.buffers + (self.closing,), self.go[idx], self.finished, visualize)
+            work.start()
+            self.works.append(work)
+        self.wait()
+
+    @staticmethod
+    def wrap(buffers):
+        # zero-copy NumPy views of the shared buffers, then the closing flag
+        *arrays, closing = buffers
+        return [np.frombuffer(raw, dtype=dtype).reshape(shape) for raw, dtype, shape in arrays] + [closing]
+
+    def wait(self):
+        # a crashed worker never releases finished, so look at the processes every second instead of blocking
+        deadline = time.perf_counter() + self.timeout
+        for _ in range(self.num_worker):
+            while not self.finished.acquire(timeout=1.0):
+                dead = [work for work in self.works if not work.is_alive()]
+                if dead or time.perf_counter() > deadline:
+                    for work in self.works:
+                        work.terminate()
+                        work.join()
+                    if dead:
+                        raise RuntimeError(f"Environment worker {dead[0].env_idx} exited with code {dead[0].exitcode}")
+                    raise RuntimeError(f"Environment workers did not finish a step within {self.timeout} seconds")
+
+    def step(self, actions):
+        self.actions[:] = actions
+        for go in self.go:
+            go.release()
+        self.wait()
+        return self.states, self.rewards, self.dones
+
+    def close(self):
+        self.closing.value = True
+        for go in self.go:
+            go.release()
+        for work in self.works:
+            work.join()
+
+
+def measure_step_throughput(env_name, num_worker=16, steps=1000):
+    # env steps per second of num_worker workers with random actions, Pipe workers against shared memory
+    env = gym.make(env_name)
+    state_size, action_size = env.observation_space.shape[0], env.action_space.shape[0]
+    env.close()
+    actions = np.random.uniform(-1.0, 1.0, size=(steps, num_worker, action_size))
+
+    works, parent_conns = [], []
+    for idx in range(num_worker):
+        parent_conn, child_conn = Pipe()
+        work = Environment(idx, child_conn, env_name, state_size, action_size)
+        work.start()
+        works.append(work)
+        parent_conns.append(parent_conn)
+    state = [parent_conn.recv() for parent_conn in parent_conns]
+    start = time.perf_counter()
+    for step in range(steps):
+        for worker_id, parent_conn in enumerate(parent_conns):
+            parent_conn.send(actions[step, worker_id])
+        for worker_id, parent_conn in enumerate(parent_conns):
+            state[worker_id] = parent_conn.recv()[0]
+        np.reshape(state, [num_worker, state_size])
+    pipe_rate = steps * num_worker / (time.perf_counter() - start)
+    for work in works:
+        work.terminate()
+        work.join()
+
+    envs = SharedMemoryVecEnv(env_name, num_worker, state_size, action_size)
+    start = time.perf_counter()
+    for step in range(steps):
+        envs.step(actions[step])
+    shared_rate = steps * num_worker / (time.perf_counter() - start)
+    envs.close()
+
+    print(f"{num_worker} workers, env steps/s: Pipe {pipe_rate:.0f}, shared memory {shared_rate:.0f} ({shared_rate / pipe_rate:.2f}x)")
+    return pipe_rate, shared_rate
+
+
+class RolloutBuffer:
+    # Fixed-size rollout storage of size steps of num_worker workers, allocated once, so memory use is known
+    # up front (nbytes) and storing a step only copies into the next row. Arrays are (step, worker, ...),
+    # rewards, dones, values and everything computed from them are float64 like the lists get_gaes works on.
+    def __init__(self, size, num_worker, state_size, action_size):
+        self.size = size
+        self.num_worker = num_worker
+        self.states = np.zeros((size, num_worker, state_size), dtype=np.float32)
+        self.next_states = np.zeros((size, num_worker, state_size), dtype=np.float32)
+        self.actions = np.zeros((size, num_worker, action_size))
+        self.rewards = np.zeros((size, num_worker))
+        self.dones = np.zeros((size, num_worker))
+        self.logp_ts = np.zeros((size, num_worker))
+        self.values = np.zeros((size, num_worker)) # filled in by the agent before compute_gaes
+        self.next_values = np.zeros((size, num_worker))
+        self.advantages = np.zeros((size, num_worker))
+        self.targets = np.zeros((size, num_worker))
+        self._coefficients = np.zeros((size, num_worker))
+        self._scratch = np.zeros(num_worker)
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in vars(self).values() if isinstance(array, np.ndarray))
+
+    @property
+    def full(self):
+        return self.count == self.size
+
+    def reset(self):
+        # nothing is cleared, the next rollout overwrites the rows
+        self.count = 0
+
+    def add(self, states, actions, rewards, dones, next_states, logp_ts):
+        # one step of every worker, (num_worker, ...) arrays or (1, ...) for a single environment
+        t = self.count
+        self.states[t] = states
+        self.actions[t] = actions
+        self.rewards[t] = rewards
+        self.dones[t] = dones
+        self.next_states[t] = next_states
+        self.logp_ts[t] = logp_ts
+        self.count += 1
+
+    def compute_gaes(self, workers=slice(None), gamma = 0.99, lamda = 0.90):
+        # get_gaes(normalize=False) of every worker in workers at once: the same operations in the same order, but
+        # always in float64, so the results equal get_gaes to float precision (given the float32 Critic outputs and
+        # Python float rewards NumPy 2 keeps get_gaes in float32, a relative difference of about 2e-7) and the
+        # backward pass runs once for all workers.
+        # Returns views of the advantages and targets (step, worker), normalizing is left to the caller
+        rewards, dones = self.rewards[:, workers], self.dones[:, workers]
+        values, next_values = self.values[:, workers], self.next_values[:, workers]
+        gaes, coefficients = self.advantages[:, workers], self._coefficients[:, workers]
+        scratch = self._scratch[workers]
+
+        # deltas = r + gamma * (1 - d) * nv - v
+        np.subtract(1, dones, out=gaes)
+        gaes *= gamma
+        gaes *= next_values
+        gaes += rewards
+        gaes -= values
+        # gaes[t] += (1 - d[t]) * gamma * lamda * gaes[t + 1]
+        np.subtract(1, dones, out=coefficients)
+        coefficients *= gamma
+        coefficients *= lamda
+        for t in reversed(range(self.size - 1)):
+            np.multiply(coefficients[t], gaes[t + 1], out=scratch)
+            gaes[t] += scratch
+
+        targets = self.targets[:, workers]
+        np.add(gaes, values, out=targets)
+        return gaes, targets
+
+
 class Actor_Model:
     def __init__(self, input_shape, action_space, lr, optimizer):
         X_input = Input(input_shape)
@@ -166,6 +372,11 @@ class PPOAgent:
         self.epochs = 10 # training epochs
         self.shuffle = True
         self.Training_batch = 512
+        # run_multiprocesses: one update over all workers' trajectories instead of one per worker. Off by default, it
+        # changes training, not only its speed: minibatch_size instead of the Keras default of 32, advantages normalized
+        # over all workers instead of per worker and one optimizer step sequence per round instead of num_worker
+        self.synchronous_update = False
+        self.minibatch_size = 256 # minibatch of the synchronous update
         #self.optimizer = RMSprop
         self.optimizer = Adam
 
@@ -220,6 +431,7 @@ class PPOAgent:
         return discounted_r
 
     def get_gaes(self, rewards, dones, values, next_values, gamma = 0.99, lamda = 0.90, normalize=True):
+        # reference for RolloutBuffer.compute_gaes, which replay uses; kept to check it against, not called in training
         deltas = [r + gamma * (1 - d) * nv - v for r, d, nv, v in zip(rewards, dones, next_values, values)]
         deltas = np.stack(deltas)
         gaes = copy.deepcopy(deltas)
@@ -231,21 +443,28 @@ class PPOAgent:
             gaes = (gaes - gaes.mean()) / (gaes.std() + 1e-8)
         return np.vstack(gaes), np.vstack(target)
 
-    def replay(self, states, actions, rewards, dones, next_states, logp_ts):
-        # reshape memory to appropriate shape for training
-        states = np.vstack(states)
-        next_states = np.vstack(next_states)
-        actions = np.vstack(actions)
-        logp_ts = np.vstack(logp_ts)
+    def replay(self, buffer, workers=slice(None), batch_size=None):
+        # train on the steps of the workers selected by the slice workers, all of them by default:
+        # a single Critic prediction for their states, GAE of every worker's segment on its own and
+        # advantages normalized over all selected steps. batch_size None is the Keras default of 32
+        states = buffer.states[:, workers].reshape(-1, buffer.states.shape[2])
+        next_states = buffer.next_states[:, workers].reshape(-1, buffer.next_states.shape[2])
+        actions = buffer.actions[:, workers].reshape(-1, buffer.actions.shape[2])
+        logp_ts = buffer.logp_ts[:, workers].reshape(-1, 1)
 
         # Get Critic network predictions 
         values = self.Critic.predict(states)
         next_values = self.Critic.predict(next_states)
+        steps = buffer.values[:, workers].shape
+        buffer.values[:, workers] = values.reshape(steps)
+        buffer.next_values[:, workers] = next_values.reshape(steps)
 
         # Compute discounted rewards and advantages
         #discounted_r = self.discount_rewards(rewards)
         #advantages = np.vstack(discounted_r - values)
-        advantages, target = self.get_gaes(rewards, dones, np.squeeze(values), np.squeeze(next_values))
+        advantages, target = buffer.compute_gaes(workers)
+        advantages, target = advantages.reshape(-1, 1), target.reshape(-1, 1)
+        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
         '''
         pylab.plot(adv,'.')
         pylab.plot(target,'-')
@@ -261,14 +480,16 @@ class PPOAgent:
         y_true = np.hstack([advantages, actions, logp_ts])
         
         # training Actor and Critic networks
-        a_loss = self.Actor.Actor.fit(states, y_true, epochs=self.epochs, verbose=0, shuffle=self.shuffle)
-        c_loss = self.Critic.Critic.fit([states, values], target, epochs=self.epochs, verbose=0, shuffle=self.shuffle)
+        a_loss = self.Actor.Actor.fit(states, y_true, epochs=self.epochs, verbose=0, shuffle=self.shuffle, batch_size=batch_size)
+        c_loss = self.Critic.Critic.fit([states, values], target, epochs=self.epochs, verbose=0, shuffle=self.shuffle, batch_size=batch_size)
+        self.log_replay(states, actions, logp_ts, a_loss, c_loss)
 
+    def log_replay(self, states, actions, logp_ts, a_loss, c_loss):
         # calculate loss parameters (should be done in loss, but couldn't find working way how to do that with disabled eager execution)
         pred = self.Actor.predict(states)
         log_std = -0.5 * np.ones(self.action_size, dtype=np.float32)
         logp = self.gaussian_likelihood(actions, pred, log_std)
-        approx_kl = np.mean(logp_ts - logp)
+        approx_kl = np.mean(logp_ts[:, 0] - logp) # logp_ts is a column, a (n, 1) - (n,) difference would be (n, n)
         approx_ent = np.mean(-logp)
 
         self.writer.add_scalar('Data/actor_loss_per_replay', np.sum(a_loss.history['loss']), self.replay_count)
@@ -277,6 +498,13 @@ class PPOAgent:
         self.writer.add_scalar('Data/approx_ent_per_replay', approx_ent, self.replay_count)
         self.replay_count += 1
  
+    def log_update_time(self, seconds, updated_workers, samples, num_worker):
+        # wall time of one round of updates, compare synchronous_update True and False with the same num_worker
+        mode = "synchronous" if self.synchronous_update else "per worker"
+        print(f"update ({mode}): {samples} samples of {updated_workers} workers in {seconds:.2f}s, {samples / seconds:.0f} samples/s")
+        self.writer.add_scalar(f'Workers:{num_worker}/update_seconds', seconds, self.replay_count)
+        self.writer.add_scalar(f'Workers:{num_worker}/update_samples_per_second', samples / seconds, self.replay_count)
+
     def load(self):
         self.Actor.Actor.load_weights(self.Actor_name)
         self.Critic.Critic.load_weights(self.Critic_name)
@@ -316,12 +544,12 @@ class PPOAgent:
         return self.average_[-1], SAVING
     
     def run_batch(self):
+        buffer = RolloutBuffer(self.Training_batch, 1, self.state_size[0], self.action_size)
+        print(f"rollout buffer: {buffer.nbytes / 2**20:.2f} MiB")
         state = self.env.reset()
         state = np.reshape(state, [1, self.state_size[0]])
         done, score, SAVING = False, 0, ''
         while True:
-            # Instantiate or reset games memory
-            states, next_states, actions, rewards, dones, logp_ts = [], [], [], [], [], []
             for t in range(self.Training_batch):
                 self.env.render()
                 # Actor picks an action
@@ -329,12 +557,7 @@ class PPOAgent:
                 # Retrieve new state, reward, and whether the state is terminal
                 next_state, reward, done, _ = self.env.step(action[0])
                 # Memorize (state, next_states, action, reward, done, logp_ts) for training
-                states.append(state)
-                next_states.append(np.reshape(next_state, [1, self.state_size[0]]))
-                actions.append(action)
-                rewards.append(reward)
-                dones.append(done)
-                logp_ts.append(logp_t[0])
+                buffer.add(state, action, reward, done, next_state, logp_t)
                 # Update current state shape
                 state = np.reshape(next_state, [1, self.state_size[0]])
                 score += reward
@@ -349,7 +572,8 @@ class PPOAgent:
                     state, done, score, SAVING = self.env.reset(), False, 0, ''
                     state = np.reshape(state, [1, self.state_size[0]])
 
-            self.replay(states, actions, rewards, dones, next_states, logp_ts)
+            self.replay(buffer)
+            buffer.reset()
             if self.episode >= self.EPISODES:
                 break
 
@@ -357,47 +581,24 @@ class PPOAgent:
 
 
     def run_multiprocesses(self, num_worker = 4):
-        works, parent_conns, child_conns = [], [], []
-        for idx in range(num_worker):
-            parent_conn, child_conn = Pipe()
-            work = Environment(idx, child_conn, self.env_name, self.state_size[0], self.action_size, True)
-            work.start()
-            works.append(work)
-            parent_conns.append(parent_conn)
-            child_conns.append(child_conn)
-
-        states =        [[] for _ in range(num_worker)]
-        next_states =   [[] for _ in range(num_worker)]
-        actions =       [[] for _ in range(num_worker)]
-        rewards =       [[] for _ in range(num_worker)]
-        dones =         [[] for _ in range(num_worker)]
-        logp_ts =       [[] for _ in range(num_worker)]
-        score =         [0 for _ in range(num_worker)]
-
-        state = [0 for _ in range(num_worker)]
-        for worker_id, parent_conn in enumerate(parent_conns):
-            state[worker_id] = parent_conn.recv()
+        envs = SharedMemoryVecEnv(self.env_name, num_worker, self.state_size[0], self.action_size, True)
+        buffer = RolloutBuffer(self.Training_batch, num_worker, self.state_size[0], self.action_size)
+        print(f"rollout buffer: {buffer.nbytes / 2**20:.2f} MiB")
+        score = np.zeros(num_worker)
 
+        state = envs.states.copy()
         while self.episode < self.EPISODES:
-            # get batch of action's and log_pi's
-            action, logp_pi = self.act(np.reshape(state, [num_worker, self.state_size[0]]))
-            
-            for worker_id, parent_conn in enumerate(parent_conns):
-                parent_conn.send(action[worker_id])
-                actions[worker_id].append(action[worker_id])
-                logp_ts[worker_id].append(logp_pi[worker_id])
-
-            for worker_id, parent_conn in enumerate(parent_conns):
-                next_state, reward, done, _ = parent_conn.recv()
+            # get batch of action's and log_pi's, the actor reads the states straight from shared memory
+            action, logp_pi = self.act(envs.states)
+            next_state, reward, done = envs.step(action)
 
-                states[worker_id].append(state[worker_id])
-                next_states[worker_id].append(next_state)
-                rewards[worker_id].append(reward)
-                dones[worker_id].append(done)
-                state[worker_id] = next_state
-                score[worker_id] += reward
+            # copied into the buffer before the next step overwrites the shared states
+            buffer.add(state, action, reward, done, next_state, logp_pi)
+            state[:] = next_state
+            score += reward
 
-                if done:
+            if done.any():
+                for worker_id in np.flatnonzero(done):
                     average, SAVING = self.PlotModel(score[worker_id], self.episode)
                     print("episode: {}/{}, worker: {}, score: {}, average: {:.2f} {}".format(self.episode, self.EPISODES, worker_id, score[worker_id], average, SAVING))
                     self.writer.add_scalar(f'Workers:{num_worker}/score_per_episode', score[worker_id], self.episode)
@@ -406,25 +607,21 @@ class PPOAgent:
                     score[worker_id] = 0
                     if(self.episode < self.EPISODES):
                         self.episode += 1
-                        
-                        
-            for worker_id in range(num_worker):
-                if len(states[worker_id]) >= self.Training_batch:
-                    self.replay(states[worker_id], actions[worker_id], rewards[worker_id], dones[worker_id], next_states[worker_id], logp_ts[worker_id])
-
-                    states[worker_id] = []
-                    next_states[worker_id] = []
-                    actions[worker_id] = []
-                    rewards[worker_id] = []
-                    dones[worker_id] = []
-                    logp_ts[worker_id] = []
+
+            # the workers step together, so all of them fill their part of the buffer at the same step
+            if buffer.full:
+                update_start = time.perf_counter()
+                if self.synchronous_update:
+                    self.replay(buffer, batch_size=self.minibatch_size)
+                else:
+                    for worker_id in range(num_worker):
+                        self.replay(buffer, slice(worker_id, worker_id + 1))
+                self.log_update_time(time.perf_counter() - update_start, num_worker, buffer.size * num_worker, num_worker)
+                buffer.reset()
 
         # terminating processes after a while loop
-        works.append(work)
-        for work in works:
-            work.terminate()
-            print('TERMINATED:', work)
-            work.join()
+        envs.close()
+        print('TERMINATED:', envs.works)
 
     def test(self, test_episodes = 100):#evaluate
         self.load()
@@ -452,4 +649,5 @@ if __name__ == "__main__":
     agent = PPOAgent(env_name)
     #agent.run_batch() # train as PPO
     #agent.run_multiprocesses(num_worker = 16)  # train PPO multiprocessed (fastest)
+    #measure_step_throughput(env_name, num_worker = 16)  # env steps/s of the Pipe and the shared-memory workers
     agent.test()
\ No newline at end of file
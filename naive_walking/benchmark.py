@@ -0,0 +1,250 @@
+"""Benchmarks of the simulation and GA hot paths
+
+Runs headless and prints one line per benchmark. Results can be saved as a
+JSON baseline and compared against an earlier one:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json --threshold 0.1
+
+A benchmark more than threshold (relative) worse than the baseline is a
+regression and makes the comparison exit with status 1.
+"""
+from universe import Figure, Universe, UniversePool
+from simulation import Simulation
+from evaluation import create_evaluator
+from ga import GeneticAlgorithm
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import pymunk
+
+# settings of the default suite
+runtimes = [6, 18]  # seconds of simulated time
+moves_per_second = 3
+population_sizes = [50, 100]
+worker_counts = [1, multiprocessing.cpu_count()]
+repeat = 3  # every benchmark keeps the best of repeat runs
+
+
+class Result:
+    """Value of a single benchmark, higher_is_better tells rates from durations"""
+    def __init__(self, value: float, unit: str, higher_is_better: bool):
+        self.value = value
+        self.unit = unit
+        self.higher_is_better = higher_is_better
+
+    def to_dict(self) -> Dict:
+        return {'value': self.value, 'unit': self.unit, 'higher_is_better': self.higher_is_better}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Result':
+        return cls(data['value'], data['unit'], data['higher_is_better'])
+
+
+def best_time(function: Callable[[], None], repeat: int = repeat) -> float:
+    """Returns the shortest wall time of repeat calls in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def random_actions(runtime: float, rng: random.Random) -> List[int]:
+    return [rng.randint(0, 3) for _ in range(int(runtime * moves_per_second))]
+
+
+def bench_steps(runtime: float) -> Result:
+    """Physics steps per second of Simulation.run in a pooled universe"""
+    rng = random.Random(0)
+    pool = UniversePool(Figure())
+    action_lists = [random_actions(runtime, rng) for _ in range(20)]
+    steps = 0
+
+    def run() -> None:
+        nonlocal steps
+        steps = 0
+        for actions in action_lists:
+            universe = pool.acquire()
+            simulation = Simulation(actions, None, runtime, universe=universe)
+            simulation.run()
+            steps += simulation.steps
+            pool.release(universe)
+
+    seconds = best_time(run)
+    return Result(steps / seconds, 'steps/s', True)
+
+
+def bench_universe_construction() -> Result:
+    """Seconds to build a Figure and its Universe, a body belongs to a single universe"""
+    count = 200
+    return Result(best_time(lambda: [Universe(Figure()) for _ in range(count)]) / count, 's', False)
+
+
+def bench_universe_reset() -> Result:
+    """Seconds to reset a pooled universe, the cost of UniversePool.acquire"""
+    universe = Universe(Figure())
+    count = 200
+    return Result(best_time(lambda: [universe.reset() for _ in range(count)]) / count, 's', False)
+
+
+def bench_evaluations(runtime: float, num_workers: int) -> Result:
+    """Evaluations per second and per core of create_evaluator"""
+    rng = random.Random(1)
+    action_lists = [random_actions(runtime, rng) for _ in range(max(40, 10 * num_workers))]
+    evaluator = create_evaluator(Figure(), runtime, num_workers=num_workers)
+    try:
+        evaluator.evaluate(action_lists[:num_workers])  # starts the workers
+        seconds = best_time(lambda: evaluator.evaluate(action_lists))
+    finally:
+        evaluator.close()
+    return Result(len(action_lists) / seconds / num_workers, 'evals/s/core', True)
+
+
+def bench_generation(runtime: float, population_size: int) -> Result:
+    """Wall time of one generation of GeneticAlgorithm.run, evaluation and reproduction"""
+    num_generations = 2
+
+    def run() -> None:
+        random.seed(2)
+        ga = GeneticAlgorithm(Figure(), population_size, num_generations, runtime,
+                              moves_per_second=moves_per_second, seed=2)
+        with contextlib.redirect_stdout(io.StringIO()):
+            ga.run()
+
+    return Result(best_time(run) / num_generations, 's', False)
+
+
+def import_cost(imports: str) -> Optional[Tuple[float, float]]:
+    """Seconds and peak memory (kB on Linux) of a new interpreter running imports, None if they fail
+
+    This is what a spawned worker process pays before its first evaluation.
+    """
+    code = ('import os, resource, time\n'
+            'start = time.perf_counter()\n'
+            '{}\n'
+            'print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)').format(imports)
+    costs = []
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+        if process.returncode != 0:
+            return None
+        seconds, memory = process.stdout.split('\n')[-2].split()
+        costs.append((float(seconds), float(memory)))
+    return min(cost[0] for cost in costs), min(cost[1] for cost in costs)
+
+
+def run_suite() -> Dict[str, Result]:
+    results = {}
+
+    def record(name: str, result: Result) -> None:
+        results[name] = result
+        print('{:<56} {:>14.6g} {}'.format(name, result.value, result.unit))
+        sys.stdout.flush()
+
+    worker = import_cost('import evaluation')
+    record('worker_startup/import_time', Result(worker[0], 's', False))
+    record('worker_startup/memory', Result(worker[1], 'kB', False))
+    # before the viewer moved to display.py every worker imported it with the simulation;
+    # without a display pyglet can only be loaded in its headless (EGL) mode
+    viewer = import_cost("import pyglet\n"
+                         "pyglet.options['headless'] = 'DISPLAY' not in os.environ\n"
+                         "import evaluation, display")
+    if viewer is None:
+        print('{:<56} {:>14}'.format('worker_startup/saved_by_headless_import', 'viewer not importable'))
+    else:
+        print('{:<56} {:>14.6g} s {:>10.6g} kB'.format('worker_startup/saved_by_headless_import',
+                                                        viewer[0] - worker[0], viewer[1] - worker[1]))
+    record('universe_construction', bench_universe_construction())
+    record('universe_reset', bench_universe_reset())
+    for runtime in runtimes:
+        record('steps_per_second/runtime={}'.format(runtime), bench_steps(runtime))
+    for runtime in runtimes:
+        for num_workers in sorted(set(worker_counts)):
+            record('evaluations_per_second_per_core/runtime={}/workers={}'.format(runtime, num_workers),
+                   bench_evaluations(runtime, num_workers))
+    for runtime in runtimes:
+        for population_size in population_sizes:
+            record('generation_time/runtime={}/population={}'.format(runtime, population_size),
+                   bench_generation(runtime, population_size))
+    return results
+
+
+def machine() -> Dict:
+    return {
+        'python': platform.python_version(),
+        'pymunk': pymunk.version,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': multiprocessing.cpu_count(),
+    }
+
+
+def save(path: str, results: Dict[str, Result]) -> None:
+    data = {
+        'machine': machine(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': {name: result.to_dict() for name, result in results.items()},
+    }
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+
+
+def load(path: str) -> Dict[str, Result]:
+    with open(path) as file:
+        data = json.load(file)
+    return {name: Result.from_dict(result) for name, result in data['results'].items()}
+
+
+def compare(baseline: Dict[str, Result], results: Dict[str, Result], threshold: float) -> List[str]:
+    """Prints the change of every benchmark and returns the names of the regressions
+
+    The change is relative to the baseline and positive when the benchmark
+    got better, whatever its direction.
+    """
+    regressions = []
+    print('\n{:<56} {:>14} {:>14} {:>9}'.format('benchmark', 'baseline', 'current', 'change'))
+    for name, result in results.items():
+        if name not in baseline:
+            print('{:<56} {:>14} {:>14.6g} {:>9}'.format(name, '-', result.value, 'new'))
+            continue
+        old = baseline[name].value
+        change = (result.value - old) / old
+        if not result.higher_is_better:
+            change = -change
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+        print('{:<56} {:>14.6g} {:>14.6g} {:>+8.1%}{}'.format(
+            name, old, result.value, change, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+# the guard keeps worker processes from re-running the suite when they import this module
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the simulation and GA hot paths')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON baseline to compare the results with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown that counts as a regression (default 0.1)')
+    args = parser.parse_args()
+
+    suite_results = run_suite()
+    if args.save:
+        save(args.save, suite_results)
+    if args.compare:
+        found = compare(load(args.compare), suite_results, args.threshold)
+        if found:
+            print('\n{} regression(s) above {:.0%}'.format(len(found), args.threshold))
+            sys.exit(1)
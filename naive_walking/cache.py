@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+import sqlite3
+
+
+class FitnessCache:
+    """Maps a list of actions and the simulation settings to a score
+
+    Recently used scores are kept in memory and the least recently used
+    one is dropped once the capacity is reached. With a path every score
+    is also written to a sqlite file, so repeated and resumed runs can skip
+    simulations they already paid for. The settings (runtime, fps,
+    moves_per_second) are part of the key, one file can hold scores of
+    runs with different settings.
+    """
+    def __init__(
+            self,
+            runtime: float,
+            fps: float = 1.0 / 30,
+            moves_per_second: float = 1.0,
+            capacity: int = 100000,  # max number of scores kept in memory
+            path: str = None  # optional sqlite file for a persistent store
+    ):
+
+        self.settings = (float(runtime), float(fps), float(moves_per_second))
+        self.capacity = capacity
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.execute('CREATE TABLE IF NOT EXISTS fitness (key TEXT PRIMARY KEY, score REAL NOT NULL)')
+            self._db.commit()
+
+    def key(self, actions: Sequence[int]) -> Tuple:
+        return self.settings + (tuple(int(action) for action in actions),)
+
+    @staticmethod
+    def _disk_key(key: Tuple) -> str:
+        runtime, fps, moves_per_second, actions = key
+        return '{!r}|{!r}|{!r}|{}'.format(runtime, fps, moves_per_second, ','.join(map(str, actions)))
+
+    def get(self, actions: Sequence[int]) -> Optional[float]:
+        """Returns the cached score or None, counts a hit or a miss"""
+        key = self.key(actions)
+        score = self._entries.get(key)
+        if score is not None:
+            self._entries.move_to_end(key)
+        elif self._db is not None:
+            row = self._db.execute('SELECT score FROM fitness WHERE key = ?', (self._disk_key(key),)).fetchone()
+            if row is not None:
+                score = row[0]
+                self._remember(key, score)
+        if score is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return score
+
+    def put(self, actions: Sequence[int], score: float) -> None:
+        key = self.key(actions)
+        self._remember(key, score)
+        if self._db is not None:
+            self._db.execute('INSERT OR REPLACE INTO fitness VALUES (?, ?)', (self._disk_key(key), score))
+
+    def _remember(self, key: Tuple, score: float) -> None:
+        self._entries[key] = score
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def reset_stats(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    def flush(self) -> None:
+        """Commits pending scores to the sqlite file"""
+        if self._db is not None:
+            self._db.commit()
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
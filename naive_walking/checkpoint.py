@@ -0,0 +1,125 @@
+from population import Population
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+import json
+import os
+import numpy as np
+
+
+class Checkpoint:
+    """Everything a GeneticAlgorithm needs to continue a run
+
+    generation is the number of generations already done, population the
+    actions (one int8 row per individual) of the next population to evaluate.
+    The states of Python's random module and of the numpy generator are kept,
+    so a resumed run draws the same individuals as an uninterrupted one.
+    """
+    def __init__(
+            self,
+            generation: int,
+            actions: np.ndarray,
+            scores: np.ndarray,
+            pruned: np.ndarray,
+            best_actions: Sequence[int],
+            best_score: float,
+            threshold: Optional[float],  # racing threshold for the next generation
+            random_state: Tuple,  # random.getstate()
+            rng_state: dict  # numpy bit generator state
+    ):
+
+        self.generation = generation
+        self.actions = actions
+        self.scores = scores
+        self.pruned = pruned
+        self.best_actions = best_actions
+        self.best_score = best_score
+        self.threshold = threshold
+        self.random_state = random_state
+        self.rng_state = rng_state
+
+    def save(self, path: str) -> None:
+        """Writes the checkpoint to a temporary file and moves it over path
+
+        The move is atomic, a crash while writing leaves the previous
+        checkpoint intact. The arrays are stored compressed in a .npz file.
+        """
+        version, internal_state, gauss_next = self.random_state
+        metadata = {
+            'generation': self.generation,
+            'best_score': self.best_score,
+            'threshold': self.threshold,
+            'random_state': [version, list(internal_state), gauss_next],
+            'rng_state': self.rng_state,
+        }
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            np.savez_compressed(
+                file,
+                actions=np.asarray(self.actions, dtype=np.int8),
+                scores=np.asarray(self.scores, dtype=np.float64),
+                pruned=np.asarray(self.pruned, dtype=bool),
+                best_actions=np.asarray(self.best_actions, dtype=np.int8),
+                metadata=np.array(json.dumps(metadata)),
+            )
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'Checkpoint':
+        with np.load(path) as data:
+            metadata = json.loads(str(data['metadata']))
+            version, internal_state, gauss_next = metadata['random_state']
+            return cls(
+                metadata['generation'],
+                data['actions'],
+                data['scores'],
+                data['pruned'],
+                [int(action) for action in data['best_actions']],
+                metadata['best_score'],
+                metadata['threshold'],
+                (version, tuple(internal_state), gauss_next),
+                metadata['rng_state'],
+            )
+
+
+class CheckpointWriter:
+    """Saves checkpoints on a background thread
+
+    The arrays of a checkpoint must not be modified after write() (pass
+    copies). At most one write is pending, a new checkpoint waits for the
+    previous one, so the evaluation only stalls if writing a checkpoint
+    takes longer than a generation.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: Future = None
+
+    def write(self, checkpoint: Checkpoint) -> None:
+        self.wait()
+        self._pending = self._executor.submit(checkpoint.save, self.path)
+
+    def wait(self) -> None:
+        """Blocks until the pending checkpoint is on disk, raises its error if writing failed"""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self) -> None:
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+
+def population_arrays(population) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns copies of the actions, scores and pruned flags of a population of any kind"""
+    if isinstance(population, Population):
+        return population.actions.copy(), population.scores.copy(), population.pruned.copy()
+    actions: List[List[int]] = [list(individual.actions) for individual in population]
+    return (
+        np.array(actions, dtype=np.int8),
+        np.array([individual.score for individual in population], dtype=np.float64),
+        np.array([individual.pruned for individual in population], dtype=bool),
+    )
@@ -0,0 +1,123 @@
+import pyglet
+from pymunk.pyglet_util import DrawOptions
+from universe import Universe, Figure
+from trajectory import Trajectory
+from schedule import ActionSchedule
+from typing import List
+
+
+class Display(pyglet.window.Window):
+    """ Given a list of actions displays the simulation using Pyglet
+    Similar code as in Simulation class.
+
+    With a recorded trajectory (see Simulation.run) the frames are played back
+    instead, without any physics, at speed times real time. During playback
+    the arrow keys seek (left/right) and change the speed (up/down), space pauses.
+    """
+    seek_seconds = 1.0
+
+    def __init__(
+            self,
+            actions: List[int],
+            figure: Figure,
+            label: str = '',
+            runtime: float = 10,
+            trajectory: Trajectory = None,
+            speed: float = 1.0  # playback only, 2.0 plays twice as fast as real time
+    ):
+
+        super().__init__(width=1000, height=400, caption='Walking evolution ', resizable=False)
+        self.actions = actions
+        self.num_actions_per_second = runtime / len(actions)
+        self.universe = Universe(figure)
+        self.current_action = 1
+        self.current_time = 0.0
+        self.fps = 1.0 / 30
+        self.runtime = runtime
+        self.schedule = ActionSchedule(actions, runtime, self.fps)
+        self.steps = 0
+        self.label = pyglet.text.Label(
+            label, font_name='Arial', font_size=22,
+            x=170, y=320, anchor_x='center', anchor_y='center',
+        )
+        self.score: float = None
+        self.trajectory = trajectory
+        self.speed = speed
+        self.paused = False
+        if trajectory is not None:
+            self.universe.set_pose(trajectory.frames[0])
+
+    def on_draw(self) -> None:
+        super().clear()
+        self.universe.space.debug_draw(DrawOptions())
+        self.label.draw()
+
+    def update(self, dt) -> None:
+        if self.trajectory is not None:
+            self.play(dt)
+            return
+
+        if self.score is not None:
+            return
+        self.universe.space.step(self.fps)
+        self.steps += 1
+        self.current_time = self.schedule.times[self.steps]
+
+        index = self.schedule.actions_at[self.steps]
+        if index is not None:
+            write = self.schedule.writes[index]
+            if write is not None:
+                self.universe.motors[write[0]].rate = write[1]
+            self.current_action = index + 2
+
+            # calculate overlap between figure and obstacle every step
+            self.universe.calculate_overlap()
+
+        # calculate distance between figure and right wall in the end of the simulation
+        if self.steps == self.schedule.num_steps:
+            self.universe.calculate_distance()
+            self.score = self.universe.score
+            self.close()
+
+    def play(self, dt: float) -> None:
+        """Advances the playback by dt seconds of wall time"""
+        if not self.paused:
+            self.seek(self.current_time + dt * self.speed)
+        if self.current_time >= self.trajectory.duration:
+            self.score = self.trajectory.score
+            self.close()
+
+    def seek(self, time: float) -> None:
+        """Shows the recorded frame closest to a point in simulated time"""
+        self.current_time = min(max(time, 0.0), self.trajectory.duration)
+        frame = int(round(self.current_time / self.trajectory.fps))
+        self.universe.set_pose(self.trajectory.frames[frame])
+
+    def on_key_press(self, symbol, modifiers) -> None:
+        if self.trajectory is None:
+            super().on_key_press(symbol, modifiers)
+            return
+        key = pyglet.window.key
+        if symbol == key.RIGHT:
+            self.seek(self.current_time + self.seek_seconds)
+        elif symbol == key.LEFT:
+            self.seek(self.current_time - self.seek_seconds)
+        elif symbol == key.UP:
+            self.speed *= 2
+        elif symbol == key.DOWN:
+            self.speed /= 2
+        elif symbol == key.SPACE:
+            self.paused = not self.paused
+        else:
+            super().on_key_press(symbol, modifiers)
+
+    def close(self) -> None:
+        super().close()
+        pyglet.app.exit()
+
+    def display_simulation(self) -> None:
+        pyglet.clock.schedule_interval(self.update, self.fps)
+        pyglet.app.run()
+
+    def get_score(self) -> float:
+        return self.score
@@ -0,0 +1,375 @@
+from simulation import Simulation
+from universe import Figure, UniversePool
+from cache import FitnessCache
+from stats import EvaluationStats
+from metrics import Metrics
+from typing import Callable, List, Sequence, Tuple
+import multiprocessing
+import math
+import time
+import numpy as np
+
+
+def evaluate_actions(
+        pool: UniversePool,
+        actions: Sequence[int],
+        runtime: float,
+        fps: float = 1.0 / 30,
+        threshold: float = None,
+        flipped_reach: float = None,
+        metrics: Metrics = None
+) -> Tuple[float, bool, int, int]:
+    """Simulates a single list of actions
+
+    Returns the score, whether the simulation was pruned (see Simulation.run),
+    the number of physics steps done and the number of steps skipped.
+    The simulation runs in a universe from the pool, the template figure
+    is never modified. Serial and parallel evaluation both go through this
+    function so they always produce the same scores.
+    With metrics the universe setup and the simulation phases are timed and
+    the universes built or reused by the pool are counted.
+    """
+    if metrics is not None:
+        start = time.perf_counter()
+        created = pool.created
+    universe = pool.acquire()
+    try:
+        simulation = Simulation(actions, None, runtime, fps, universe=universe)
+        if metrics is not None:
+            metrics.add('setup', time.perf_counter() - start)
+            metrics.count('universes_created', pool.created - created)
+            metrics.count('universes_reused', 1 - (pool.created - created))
+        simulation.run(threshold=threshold, flipped_reach=flipped_reach, metrics=metrics)
+        steps_skipped = simulation.remaining_steps() if simulation.pruned else 0
+        return simulation.evaluate(), simulation.pruned, simulation.steps, steps_skipped
+    finally:
+        pool.release(universe)
+
+
+def _collect(results: List[Tuple[float, bool, int, int]], stats: EvaluationStats) -> Tuple[List[float], List[bool]]:
+    scores, pruned = [], []
+    for score, was_pruned, steps, steps_skipped in results:
+        stats.add(steps, was_pruned, steps_skipped)
+        scores.append(score)
+        pruned.append(was_pruned)
+    return scores, pruned
+
+
+class SerialEvaluator:
+    """Evaluates the action lists of a population one after another
+
+    evaluate() returns the scores, the pruned flags of the last call are
+    kept in self.pruned and the work done is counted in self.stats.
+    """
+    def __init__(
+            self,
+            figure: Figure,
+            runtime: float = 10,  # in seconds
+            fps: float = 1.0 / 30,
+            flipped_reach: float = None,  # see Simulation.lower_bound
+            metrics: Metrics = None,  # times the phases of every simulation
+            iterations: int = 10  # solver iterations per physics step
+    ):
+
+        self.figure = figure
+        self.runtime = runtime
+        self.fps = fps
+        self.flipped_reach = flipped_reach
+        self.metrics = metrics
+        self.pool = UniversePool(figure, iterations)
+        self.pruned: List[bool] = []
+        self.stats = EvaluationStats()
+
+    def evaluate(self, population_actions: Sequence[Sequence[int]], threshold: float = None) -> List[float]:
+        start = time.perf_counter()
+        results = [
+            evaluate_actions(self.pool, actions, self.runtime, self.fps, threshold, self.flipped_reach, self.metrics)
+            for actions in population_actions
+        ]
+        self.stats.seconds += time.perf_counter() - start
+        scores, self.pruned = _collect(results, self.stats)
+        return scores
+
+    def submit(
+            self,
+            actions: Sequence[int],
+            threshold: float,
+            callback: Callable[[float, bool], None],
+            error_callback: Callable[[BaseException], None]
+    ) -> None:
+        """Evaluates a single action list and calls callback(score, pruned), see ParallelEvaluator.submit"""
+        try:
+            score, pruned, steps, steps_skipped = evaluate_actions(
+                self.pool, actions, self.runtime, self.fps, threshold, self.flipped_reach, self.metrics)
+        except Exception as error:
+            error_callback(error)
+            return
+        self.stats.add(steps, pruned, steps_skipped)
+        callback(score, pruned)
+
+    def close(self) -> None:
+        pass
+
+
+# state of a single worker process, set once by _init_worker
+_worker_pool: UniversePool = None
+_worker_runtime: float = None
+_worker_fps: float = None
+_worker_flipped_reach: float = None
+
+
+def _init_worker(figure: Figure, runtime: float, fps: float, flipped_reach: float, iterations: int) -> None:
+    global _worker_pool, _worker_runtime, _worker_fps, _worker_flipped_reach
+    _worker_pool = UniversePool(figure, iterations)
+    _worker_runtime = runtime
+    _worker_fps = fps
+    _worker_flipped_reach = flipped_reach
+
+
+def _evaluate_in_worker(task: Tuple[List[int], float, bool]) -> Tuple[Tuple[float, bool, int, int], Tuple]:
+    actions, threshold, instrumented = task
+    metrics = Metrics() if instrumented else None
+    result = evaluate_actions(_worker_pool, actions, _worker_runtime, _worker_fps, threshold, _worker_flipped_reach,
+                              metrics)
+    if metrics is None:
+        return result, None
+    # the phases are timed in the worker and merged into the metrics of the main process
+    return result, (dict(metrics.phases), dict(metrics.counters))
+
+
+class ParallelEvaluator:
+    """Evaluates the action lists of a population on a pool of processes
+
+    The pool is created once and lives until close() is called. Every worker
+    receives the figure a single time when it starts and keeps a universe
+    pool for it, so a task only carries the list of actions.
+    """
+    def __init__(
+            self,
+            figure: Figure,
+            runtime: float = 10,  # in seconds
+            fps: float = 1.0 / 30,
+            num_workers: int = None,  # defaults to the number of CPUs
+            flipped_reach: float = None,  # see Simulation.lower_bound
+            metrics: Metrics = None,  # times the phases of every simulation, summed over the workers
+            iterations: int = 10  # solver iterations per physics step
+    ):
+
+        self.runtime = runtime
+        self.fps = fps
+        self.metrics = metrics
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.pruned: List[bool] = []
+        self.stats = EvaluationStats()
+        self._pool = multiprocessing.Pool(
+            self.num_workers, initializer=_init_worker, initargs=(figure, runtime, fps, flipped_reach, iterations)
+        )
+
+    def evaluate(self, population_actions: Sequence[Sequence[int]], threshold: float = None) -> List[float]:
+        start = time.perf_counter()
+        instrumented = self.metrics is not None
+        tasks = [(list(actions), threshold, instrumented) for actions in population_actions]
+        # a few chunks per worker keeps the IPC overhead low without starving any worker
+        chunksize = max(1, len(tasks) // (4 * self.num_workers))
+        results = []
+        for result, worker_metrics in self._pool.map(_evaluate_in_worker, tasks, chunksize):
+            results.append(result)
+            if worker_metrics is not None:
+                self.metrics.merge(*worker_metrics)
+        # CPU time of the whole pool
+        self.stats.seconds += (time.perf_counter() - start) * self.num_workers
+        scores, self.pruned = _collect(results, self.stats)
+        return scores
+
+    def submit(
+            self,
+            actions: Sequence[int],
+            threshold: float,
+            callback: Callable[[float, bool], None],
+            error_callback: Callable[[BaseException], None]
+    ) -> None:
+        """Evaluates a single action list on the next free worker without waiting for it
+
+        callback(score, pruned) or error_callback(error) is called from the
+        result thread of the pool once the simulation is done.
+        """
+        def finished(output: Tuple[Tuple[float, bool, int, int], Tuple]) -> None:
+            (score, pruned, steps, steps_skipped), worker_metrics = output
+            self.stats.add(steps, pruned, steps_skipped)
+            if worker_metrics is not None:
+                self.metrics.merge(*worker_metrics)
+            callback(score, pruned)
+
+        task = (list(actions), threshold, self.metrics is not None)
+        self._pool.apply_async(_evaluate_in_worker, (task,), callback=finished, error_callback=error_callback)
+
+    def close(self) -> None:
+        self._pool.close()
+        self._pool.join()
+
+
+class CachedEvaluator:
+    """Looks up scores in a fitness cache before simulating
+
+    Only the action lists missing from the cache are handed to the wrapped
+    evaluator, each distinct list once, and their scores are added to the cache.
+    Scores of pruned simulations are only lower bounds and are not cached.
+    """
+    def __init__(self, evaluator, cache: FitnessCache):
+        self.evaluator = evaluator
+        self.cache = cache
+        self.pruned: List[bool] = []
+
+    @property
+    def stats(self) -> EvaluationStats:
+        return self.evaluator.stats
+
+    def evaluate(self, population_actions: Sequence[Sequence[int]], threshold: float = None) -> List[float]:
+        scores = []
+        self.pruned = [False] * len(population_actions)
+        missing = {}  # cache key -> (actions, indices of the individuals waiting for the score)
+        for index, actions in enumerate(population_actions):
+            score = self.cache.get(actions)
+            if score is None:
+                key = self.cache.key(actions)
+                missing.setdefault(key, (actions, []))[1].append(index)
+            scores.append(score)
+
+        if missing:
+            pending = list(missing.values())
+            new_scores = self.evaluator.evaluate([actions for actions, _ in pending], threshold)
+            for (actions, indices), score, pruned in zip(pending, new_scores, self.evaluator.pruned):
+                if not pruned:
+                    self.cache.put(actions, score)
+                for index in indices:
+                    scores[index] = score
+                    self.pruned[index] = pruned
+        self.cache.flush()
+        return scores
+
+    def close(self) -> None:
+        self.evaluator.close()
+        self.cache.close()
+
+
+class Screening:
+    """Settings of the coarse simulation that screens a population, see MultiFidelityEvaluator"""
+    def __init__(
+            self,
+            fraction: float = 0.3,  # share of the population re-simulated at the reference settings
+            fps: float = 1.0 / 15,  # physics time step of the coarse simulation
+            iterations: int = 5,  # solver iterations of the coarse simulation, the reference uses 10
+            horizon: float = 1.0,  # share of the actions (and runtime) simulated when screening
+            audit_fraction: float = 0.0  # share of the other individuals re-simulated too, to measure agreement
+    ):
+
+        self.fraction = fraction
+        self.fps = fps
+        self.iterations = iterations
+        self.horizon = horizon
+        self.audit_fraction = audit_fraction
+
+
+def spearman(a: Sequence[float], b: Sequence[float]) -> float:
+    """Spearman rank correlation, 1.0 when both orders are the same"""
+    if len(a) < 2:
+        return float('nan')
+    rank_a = np.argsort(np.argsort(a, kind='stable'), kind='stable').astype(float)
+    rank_b = np.argsort(np.argsort(b, kind='stable'), kind='stable').astype(float)
+    if rank_a.std() == 0 or rank_b.std() == 0:
+        return float('nan')
+    return float(np.corrcoef(rank_a, rank_b)[0, 1])
+
+
+class MultiFidelityEvaluator:
+    """Screens a population with a coarse simulation and confirms the best at full fidelity
+
+    Every action list is first simulated by the coarse evaluator (larger time
+    step, fewer solver iterations and/or only the first horizon actions).
+    The best fraction by coarse score, and a random audit_fraction of the
+    others, are simulated again by the fine (reference) evaluator. Only
+    these confirmed individuals get a score, the others get infinity and are
+    flagged as pruned, so they can never become elites and are not cached.
+    The Spearman correlation of coarse and fine scores over the confirmed
+    individuals of the last call is kept in self.rank_agreement.
+    """
+    def __init__(self, coarse, fine, screening: Screening, num_actions: int, seed: int = None):
+        self.coarse = coarse
+        self.fine = fine
+        self.screening = screening
+        self.num_coarse_actions = max(1, int(round(num_actions * screening.horizon)))
+        self.pruned: List[bool] = []
+        self.confirmed = 0  # individuals simulated at full fidelity in the last call
+        self.rank_agreement = float('nan')
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def stats(self) -> EvaluationStats:
+        return self.fine.stats
+
+    @property
+    def coarse_stats(self) -> EvaluationStats:
+        return self.coarse.stats
+
+    def evaluate(self, population_actions: Sequence[Sequence[int]], threshold: float = None) -> List[float]:
+        size = len(population_actions)
+        coarse_scores = self.coarse.evaluate([actions[:self.num_coarse_actions] for actions in population_actions])
+        order = np.argsort(coarse_scores, kind='stable')
+        num_top = min(size, max(1, int(math.ceil(size * self.screening.fraction))))
+        confirmed = list(order[:num_top])
+        others = order[num_top:]
+        num_audit = int(round(len(others) * self.screening.audit_fraction))
+        if num_audit > 0:
+            confirmed.extend(self._rng.choice(others, size=num_audit, replace=False))
+
+        fine_scores = self.fine.evaluate([population_actions[index] for index in confirmed], threshold)
+        scores = [math.inf] * size
+        self.pruned = [True] * size
+        for index, score, pruned in zip(confirmed, fine_scores, self.fine.pruned):
+            scores[index] = score
+            self.pruned[index] = pruned
+        self.confirmed = len(confirmed)
+        complete = [i for i, pruned in enumerate(self.fine.pruned) if not pruned]
+        self.rank_agreement = spearman([coarse_scores[confirmed[i]] for i in complete],
+                                       [fine_scores[i] for i in complete])
+        return scores
+
+    def close(self) -> None:
+        self.coarse.close()
+        self.fine.close()
+
+
+def create_evaluator(
+        figure: Figure,
+        runtime: float = 10,
+        fps: float = 1.0 / 30,
+        num_workers: int = 1,
+        cache: FitnessCache = None,
+        flipped_reach: float = None,
+        metrics: Metrics = None,
+        screening: Screening = None,
+        num_actions: int = None  # length of the action lists, needed for a screening horizon
+):
+    """Returns a serial evaluator for a single worker, a process pool otherwise
+
+    With screening the population is first simulated at a coarse fidelity
+    (MultiFidelityEvaluator).
+    With a fitness cache the evaluator is wrapped in a CachedEvaluator.
+    With metrics every simulation reports the time spent in its phases.
+    """
+    serial = num_workers is not None and num_workers <= 1
+    if serial:
+        evaluator = SerialEvaluator(figure, runtime, fps, flipped_reach, metrics)
+    else:
+        evaluator = ParallelEvaluator(figure, runtime, fps, num_workers, flipped_reach, metrics)
+    if screening is not None:
+        coarse_runtime = runtime * max(1, int(round(num_actions * screening.horizon))) / num_actions
+        if serial:
+            coarse = SerialEvaluator(figure, coarse_runtime, screening.fps, iterations=screening.iterations)
+        else:
+            coarse = ParallelEvaluator(figure, coarse_runtime, screening.fps, num_workers,
+                                       iterations=screening.iterations)
+        evaluator = MultiFidelityEvaluator(coarse, evaluator, screening, num_actions)
+    if cache is not None:
+        evaluator = CachedEvaluator(evaluator, cache)
+    return evaluator
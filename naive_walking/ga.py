@@ -1,7 +1,18 @@
-from simulation import Simulation, Figure
-from typing import List
+from universe import Figure
+from evaluation import Screening, create_evaluator
+from cache import FitnessCache
+from population import Population
+from checkpoint import Checkpoint, CheckpointWriter, population_arrays
+from metrics import Metrics
+from results import ResultWriter
+from surrogate import Surrogate
+from typing import List, Union
+import bisect
+import math
+import numpy as np
+import queue
 import random
-import copy
+import time
 
 
 class Individual:
@@ -15,6 +26,7 @@ class Individual:
     def __init__(self, actions: List[int]):
         self.actions = actions
         self.score = 0.0
+        self.pruned = False  # simulation stopped early, score is a lower bound
 
     def set_score(self, score: float) -> None:
         self.score = score
@@ -30,6 +42,21 @@ class GeneticAlgorithm:
             elitism_size: float = 0.1,
             crossover_size: float = 0.4,
             moves_per_second: float = 1.0,
+            num_workers: int = 1,  # number of processes simulating the population, None for all CPUs
+            cache_size: int = 0,  # number of scores kept in memory, 0 disables the fitness cache
+            cache_path: str = None,  # optional sqlite file that keeps scores across runs
+            vectorized: bool = False,  # keep the population in numpy arrays (see population.Population)
+            seed: int = None,  # seed of the numpy generator used by the vectorized operators
+            racing: bool = False,  # stop simulations that can no longer reach the elites
+            flipped_reach: float = None,  # with racing, prune flipped figures too (see Simulation.lower_bound)
+            checkpoint_path: str = None,  # .npz file written every checkpoint_every generations, see resume()
+            checkpoint_every: int = 1,
+            metrics: Metrics = None,  # receives per-phase timings of every generation, e.g. metrics.JsonlMetrics
+            migration=None,  # island.Migration, exchanges individuals with other islands
+            steady_state: bool = False,  # replace generations by a continuously updated population, see run()
+            screening: Screening = None,  # simulate at a coarse fidelity first, see evaluation.MultiFidelityEvaluator
+            results_path: str = None,  # directory every evaluated genome and score is appended to, see results
+            surrogate: Surrogate = None,  # simulate only the most promising crossover offspring, see surrogate
     ):
 
         self.figure = figure
@@ -39,8 +66,47 @@ class GeneticAlgorithm:
         self.crossover_rate = crossover_rate
         self.elitism_size = elitism_size
         self.crossover_size = crossover_size
+        self.moves_per_second = moves_per_second
         self.individual_size = self.sim_runtime * moves_per_second  # number of actions in one simulation
+        self.num_workers = num_workers
+        self.cache_size = cache_size
+        self.cache_path = cache_path
+        self.vectorized = vectorized
+        self.rng = np.random.default_rng(seed)
+        self.racing = racing
+        self.flipped_reach = flipped_reach
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.metrics = metrics
+        self.migration = migration
+        self.steady_state = steady_state
+        self.screening = screening
+        self.results_path = results_path
+        self.surrogate = surrogate
+        if surrogate is not None and steady_state:
+            raise ValueError('steady_state does not support a surrogate')
+        if screening is not None and screening.fraction < elitism_size:
+            raise ValueError('Screening must confirm at least the elites, use a fraction >= elitism_size')
+        if screening is not None and steady_state:
+            raise ValueError('steady_state does not support screening')
+        if steady_state and (vectorized or checkpoint_path or migration):
+            raise ValueError('steady_state supports neither vectorized populations, checkpoints nor migration')
         self.best_individual = None
+        # state of the run, advanced by ask() and tell()
+        self.population = None  # current generation, created by the first ask()
+        self.generation = 0  # generations finished so far
+        self.threshold = None  # racing threshold, the score of the worst elite of the previous generation
+        self.evaluation_seconds = 0.0  # from the first ask() to the last tell() of the previous generation
+        self.simulations = 0  # simulations run by run(), without cache hits and skipped individuals
+        self._waiting: List[int] = None  # indices not handed out by ask() yet, None between generations
+        self._asked = {}  # action tuple -> indices handed out by ask() without a score
+        self._unscored = 0  # individuals of the generation still without a score
+        self._rejected = set()  # crossover offspring the surrogate rejected, never simulated
+        self._scores: List[float] = []
+        self._pruned: List[bool] = []
+        self._generation_start = 0.0
+        self._checkpoints: CheckpointWriter = None
+        self._results: ResultWriter = None
 
     def random_population(self, population_size: int) -> List[Individual]:
         """Creates a random population of n individuals
@@ -55,10 +121,19 @@ class GeneticAlgorithm:
             population.append(individual)
         return population
 
+    def initial_population(self) -> Union[List[Individual], Population]:
+        """Creates the random first population, a Population if vectorized"""
+        if self.vectorized:
+            return Population.random(self.population_size, int(self.individual_size), self.rng)
+        return self.random_population(self.population_size)
+
     def evaluate_population(self, population) -> None:
+        if isinstance(population, Population):
+            population.sort()
+            return
         population.sort(key=lambda population: population.score)
 
-    def create_next_population(self, population_sorted) -> List[Individual]:
+    def create_next_population(self, population_sorted) -> Union[List[Individual], Population]:
         """Creates a new population
 
         New population consists of elites, crossovers, and random individuals
@@ -67,6 +142,12 @@ class GeneticAlgorithm:
         num_elites = int(self.population_size * self.elitism_size)
         num_crossovers = int(self.population_size * self.crossover_size)
         num_random = self.population_size - num_elites - num_crossovers
+        if isinstance(population_sorted, Population):
+            return Population.concatenate(
+                population_sorted.elites(num_elites),
+                population_sorted.crossover(num_elites, num_crossovers, self.crossover_rate, self.rng),
+                Population.random(num_random, int(self.individual_size), self.rng)
+            )
         for n in range(num_elites):
             new_population.append(population_sorted[n])
         for n in range(num_crossovers):
@@ -90,23 +171,383 @@ class GeneticAlgorithm:
         new_individual = Individual(mutation)
         return new_individual
 
+    @property
+    def finished(self) -> bool:
+        return self.generation >= self.num_generations
+
+    def ask(self, n: int = None) -> List[List[int]]:
+        """Returns up to n action lists of the current generation to simulate, all of them if n is None
+
+        Once every action list of the generation is handed out, ask returns
+        an empty list until tell() has all their scores and the next
+        generation is created; after the last generation it always does.
+        """
+        if self.finished:
+            return []
+        if self._waiting is None:
+            self._start_generation()
+        count = len(self._waiting) if n is None else min(n, len(self._waiting))
+        actions_list = []
+        for index in self._waiting[:count]:
+            actions = [int(action) for action in self.population[index].actions]
+            self._asked.setdefault(tuple(actions), []).append(index)
+            actions_list.append(actions)
+        del self._waiting[:count]
+        return actions_list
+
+    def tell(self, actions_list: List[List[int]], scores: List[float], pruned: List[bool] = None) -> bool:
+        """Takes the scores of action lists returned by ask(), in any order and batches of any size
+
+        pruned flags scores that are only lower bounds, e.g. of simulations
+        stopped by racing at self.threshold. The generation ends with the
+        last missing score: the population is sorted, checkpointed and
+        logged and the next generation is created. Returns whether that
+        happened.
+        """
+        if pruned is None:
+            pruned = [False] * len(scores)
+        if not len(actions_list) == len(scores) == len(pruned):
+            raise ValueError('tell needs one score and pruned flag per action list')
+        for actions, score, was_pruned in zip(actions_list, scores, pruned):
+            key = tuple(int(action) for action in actions)
+            indices = self._asked.get(key)
+            if not indices:
+                raise ValueError('{} was not returned by ask() or already has a score'.format(list(key)))
+            index = indices.pop()
+            if not indices:
+                del self._asked[key]
+            self._scores[index] = score
+            self._pruned[index] = bool(was_pruned)
+            self._unscored -= 1
+        if self._unscored > 0:
+            return False
+        self._next_generation()
+        return True
+
+    def close(self) -> None:
+        """Waits for the last checkpoint and closes the result log, called by run() and after the last generation"""
+        if self._checkpoints is not None:
+            self._checkpoints.close()
+            self._checkpoints = None
+        if self._results is not None:
+            self._results.close()
+            self._results = None
+
     def run(self) -> None:
         """Runs for n generations
 
         Creates a simulation with the default figure and the action list
         provided in the individual. Evaluates (sorts) the population by
         individual score and generates the next population.
+        With num_workers > 1 the simulations run on a pool of processes.
+        With racing, simulations that can no longer beat the worst elite of
+        the previous generation are stopped early and flagged as pruned.
+        With a checkpoint_path the state of the run is saved in the background
+        every checkpoint_every generations, see resume().
+        With metrics a record of every generation (wall time per phase,
+        evaluations per second, cache and pool counters) is handed to it.
+        With steady_state there are no generations, see run_steady_state().
+        The loop only drives ask() and tell(), which other schedulers can
+        call directly to evaluate the individuals however they like.
+        """
+        if self.steady_state:
+            self.run_steady_state()
+            return
+        self._run()
+
+    def run_steady_state(self) -> None:
+        """Evolves the population without waiting for whole generations
+
+        Every worker always has a simulation to run. As soon as one finishes,
+        its individual replaces the worst one of the population if it is
+        better, and a new offspring is submitted right away: a crossover of
+        a random elite and a random non-elite, or a random individual, in
+        the proportions of crossover_size and the random share of the
+        generational GA. The first population_size individuals are random.
+        The run does population_size * num_generations evaluations, the
+        progress is printed every population_size of them.
+        """
+        num_elites = max(1, int(self.population_size * self.elitism_size))
+        random_size = max(0.0, 1.0 - self.elitism_size - self.crossover_size)
+        crossover_share = self.crossover_size / (self.crossover_size + random_size) if self.crossover_size else 0.0
+        budget = self.population_size * self.num_generations
+        cache = None
+        if self.cache_size > 0 or self.cache_path is not None:
+            cache = FitnessCache(self.sim_runtime, moves_per_second=self.moves_per_second,
+                                 capacity=self.cache_size, path=self.cache_path)
+        evaluator = create_evaluator(self.figure, self.sim_runtime, num_workers=self.num_workers,
+                                     flipped_reach=self.flipped_reach, metrics=self.metrics)
+        # a second task per worker hides the round trip to the pool
+        max_in_flight = 2 * getattr(evaluator, 'num_workers', 1)
+        finished = queue.Queue()  # (individual, score, pruned) or an exception from a worker
+        population: List[Individual] = []  # sorted by score, best first
+        scores: List[float] = []  # scores of the population, kept for bisect
+        submitted = done = in_flight = 0
+        results = None
+        if self.results_path is not None:
+            results = ResultWriter(self.results_path, int(self.individual_size), runtime=self.sim_runtime)
+        evaluated: List[Individual] = []  # since the last progress report, appended to the results
+        block_start = time.perf_counter()
+
+        def offspring() -> Individual:
+            if len(population) < self.population_size or len(population) <= num_elites:
+                return self.random_population(1)[0]
+            if random.uniform(0, 1) < crossover_share:
+                elite = population[random.randint(0, num_elites - 1)].actions
+                non_elite = population[random.randint(num_elites, len(population) - 1)].actions
+                return self.crossover(elite, non_elite)
+            return self.random_population(1)[0]
+
+        def insert(individual: Individual) -> None:
+            if len(population) >= self.population_size:
+                if individual.score >= scores[-1]:
+                    return
+                population.pop()
+                scores.pop()
+            index = bisect.bisect_right(scores, individual.score)
+            population.insert(index, individual)
+            scores.insert(index, individual.score)
+
+        try:
+            if self.metrics is not None:
+                self.metrics.start_generation()
+            while done < budget:
+                while in_flight < max_in_flight and submitted < budget:
+                    individual = offspring()
+                    submitted += 1
+                    score = cache.get(individual.actions) if cache is not None else None
+                    if score is not None:
+                        finished.put((individual, score, False))
+                        in_flight += 1
+                        continue
+                    threshold = None
+                    if self.racing and len(population) >= self.population_size:
+                        threshold = population[num_elites - 1].score
+                    self.simulations += 1
+                    evaluator.submit(
+                        individual.actions, threshold,
+                        lambda score, pruned, individual=individual: finished.put((individual, score, pruned)),
+                        finished.put
+                    )
+                    in_flight += 1
+
+                result = finished.get()
+                if isinstance(result, BaseException):
+                    raise result
+                individual, score, pruned = result
+                in_flight -= 1
+                done += 1
+                individual.set_score(score)
+                individual.pruned = pruned
+                if cache is not None and not pruned:
+                    cache.put(individual.actions, score)
+                insert(individual)
+                if results is not None:
+                    evaluated.append(individual)
+                self.best_individual = population[0]
+
+                if done % self.population_size == 0:
+                    generation = done // self.population_size
+                    if self.metrics is not None:
+                        self.metrics.end_generation(generation, evaluations=self.population_size,
+                                                    best_score=float(self.best_individual.score))
+                        self.metrics.start_generation()
+                    if results is not None:
+                        # no barrier, every block of population_size evaluations counts as a generation
+                        seconds = time.perf_counter() - block_start
+                        results.append(generation, *population_arrays(evaluated), evaluation_seconds=seconds,
+                                       generation_seconds=seconds)
+                        evaluated = []
+                        block_start = time.perf_counter()
+                    print('Evaluations {} (generation {})'.format(done, generation))
+                    if results is None:
+                        print('Best actions: {}'.format([int(action) for action in self.best_individual.actions]))
+                    if cache is not None:
+                        cache.flush()
+                        print('Cache hits: {}, misses: {}'.format(cache.hits, cache.misses))
+                        cache.reset_stats()
+                    if self.racing:
+                        stats = evaluator.stats
+                        print('Pruned: {}, physics steps skipped: {}'.format(stats.pruned, stats.steps_skipped))
+                        stats.reset()
+                    print('Best score: {}\n'.format(int(self.best_individual.score)))
+        finally:
+            evaluator.close()
+            if cache is not None:
+                cache.close()
+            if results is not None:
+                results.close()
+
+    def resume(self) -> None:
+        """Continues the run saved at checkpoint_path
+
+        Restores the population, the best individual, the racing threshold and
+        the random generators, then runs the remaining generations. A run
+        continued this way evaluates the same individuals as a run that was
+        never interrupted.
         """
-        population = self.random_population(self.population_size)
-        for n in range(self.num_generations):
-            for individual in population:
-                fig = copy.deepcopy(self.figure)
-                simulation = Simulation(individual.actions, fig, self.sim_runtime)
-                simulation.run()
-                individual.set_score(simulation.evaluate())
-            self.evaluate_population(population)
-            self.best_individual = population[0]
-            population = self.create_next_population(population)
-            print('Generation {}'.format(n + 1))
-            print('Best actions: {}'.format(self.best_individual.actions))
-            print('Best score: {}\n'.format(int(self.best_individual.score)))
+        checkpoint = Checkpoint.load(self.checkpoint_path)
+        random.setstate(checkpoint.random_state)
+        self.rng.bit_generator.state = checkpoint.rng_state
+        if self.vectorized:
+            population = Population(checkpoint.actions, checkpoint.scores, checkpoint.pruned)
+        else:
+            population = []
+            for actions, score, pruned in zip(checkpoint.actions, checkpoint.scores, checkpoint.pruned):
+                individual = Individual([int(action) for action in actions])
+                individual.set_score(float(score))
+                individual.pruned = bool(pruned)
+                population.append(individual)
+        self.best_individual = Individual(checkpoint.best_actions)
+        self.best_individual.set_score(checkpoint.best_score)
+        self.population = population
+        self.generation = checkpoint.generation
+        self.threshold = checkpoint.threshold
+        self._waiting = None
+        print('---Resuming after generation {}---'.format(checkpoint.generation))
+        self._run()
+
+    def _start_generation(self) -> None:
+        if self.population is None:
+            self.population = self.initial_population()
+        if self.checkpoint_path is not None and self._checkpoints is None:
+            self._checkpoints = CheckpointWriter(self.checkpoint_path)
+        if self.results_path is not None and self._results is None:
+            self._results = ResultWriter(self.results_path, int(self.individual_size), self.generation,
+                                         runtime=self.sim_runtime)
+        self._generation_start = time.perf_counter()
+        size = len(self.population)
+        self._scores = [math.inf] * size
+        self._pruned = [True] * size
+        self._rejected = set()
+        # only populations made by create_next_population have crossover offspring, they follow the elites
+        if self.surrogate is not None and self.generation > 0:
+            first = int(self.population_size * self.elitism_size)
+            offspring = list(range(first, min(size, first + int(self.population_size * self.crossover_size))))
+            selected = self.surrogate.select([self.population[index].actions for index in offspring])
+            self._rejected = set(offspring) - {offspring[index] for index in selected}
+        self._waiting = [index for index in range(size) if index not in self._rejected]
+        self._unscored = len(self._waiting)
+        self._asked = {}
+
+    def _next_generation(self) -> None:
+        """Sorts the scored generation, creates the next one and saves the state of the run"""
+        self.evaluation_seconds = time.perf_counter() - self._generation_start
+        population = self.population
+        for individual, score, pruned in zip(population, self._scores, self._pruned):
+            individual.set_score(score)
+            individual.pruned = pruned
+        if self.surrogate is not None:
+            # scores of pruned simulations are lower bounds (or infinite after screening), not fitness
+            simulated = [index for index in range(len(population))
+                         if index not in self._rejected and not self._pruned[index]]
+            if self.generation > 0:
+                first = int(self.population_size * self.elitism_size)
+                offspring = range(first, min(len(population), first + int(self.population_size * self.crossover_size)))
+                # lower bounds of pruned simulations would distort the accuracy
+                self.surrogate.measure([math.inf if self._pruned[index] else self._scores[index]
+                                        for index in offspring])
+            self.surrogate.update([population[index].actions for index in simulated],
+                                  [self._scores[index] for index in simulated])
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        self.evaluate_population(population)
+        if metrics is not None:
+            metrics.add('sort', time.perf_counter() - start)
+        self.best_individual = population[0]
+        evaluated = population_arrays(population) if self._results is not None else None
+        num_elites = int(self.population_size * self.elitism_size)
+        if self.racing and num_elites > 0:
+            # an individual worse than this cannot become an elite of the next generation
+            self.threshold = population[num_elites - 1].score
+        if metrics is not None:
+            start = time.perf_counter()
+        self.population = self.create_next_population(population)
+        if self.migration is not None:
+            # migrants take the place of the last offspring and are simulated with the settings of this island
+            self.migration.exchange(self.generation + 1, population, self.population, num_elites)
+        if metrics is not None:
+            metrics.add('reproduction', time.perf_counter() - start)
+        self.generation += 1
+        self._waiting = None
+        if self._checkpoints is not None and (self.generation % self.checkpoint_every == 0 or self.finished):
+            self._checkpoints.write(self._checkpoint(self.population, self.generation, self.threshold))
+        if self._results is not None:
+            self._results.append(self.generation, *evaluated, evaluation_seconds=self.evaluation_seconds,
+                                 generation_seconds=time.perf_counter() - self._generation_start)
+        if self.finished:
+            self.close()
+
+    def _checkpoint(self, population, generation: int, threshold: float) -> Checkpoint:
+        actions, scores, pruned = population_arrays(population)
+        return Checkpoint(
+            generation, actions, scores, pruned,
+            [int(action) for action in self.best_individual.actions], float(self.best_individual.score),
+            threshold, random.getstate(), self.rng.bit_generator.state
+        )
+
+    def _end_generation(self, generation: int, evaluator, cache: FitnessCache, evaluation_seconds: float) -> None:
+        stats = evaluator.stats
+        self.metrics.end_generation(
+            generation,
+            evaluation_seconds=evaluation_seconds,
+            evaluations=stats.simulations,
+            evaluations_per_second=stats.simulations / evaluation_seconds if evaluation_seconds > 0 else 0.0,
+            physics_steps=stats.steps,
+            pruned=stats.pruned,
+            cache_hits=cache.hits if cache is not None else None,
+            cache_misses=cache.misses if cache is not None else None,
+            best_score=float(self.best_individual.score),
+            surrogate_skipped=self.surrogate.skipped if self.surrogate is not None else None,
+            surrogate_rank_agreement=self.surrogate.rank_agreement if self.surrogate is not None else None,
+        )
+
+    def _run(self) -> None:
+        """Drives ask() and tell() with an evaluator until the last generation, printing every generation"""
+        cache = None
+        if self.cache_size > 0 or self.cache_path is not None:
+            cache = FitnessCache(self.sim_runtime, moves_per_second=self.moves_per_second,
+                                 capacity=self.cache_size, path=self.cache_path)
+        evaluator = create_evaluator(self.figure, self.sim_runtime, num_workers=self.num_workers, cache=cache,
+                                     flipped_reach=self.flipped_reach, metrics=self.metrics,
+                                     screening=self.screening, num_actions=int(self.individual_size))
+        # the multi-fidelity evaluator, possibly wrapped by the cache
+        screener = getattr(evaluator, 'evaluator', evaluator) if self.screening is not None else None
+        metrics = self.metrics
+        try:
+            while not self.finished:
+                if cache is not None:
+                    cache.reset_stats()
+                evaluator.stats.reset()
+                if screener is not None:
+                    screener.coarse_stats.reset()
+                if metrics is not None:
+                    metrics.start_generation()
+                actions_list = self.ask()
+                scores = evaluator.evaluate(actions_list, self.threshold)
+                self.tell(actions_list, scores, evaluator.pruned)
+                self.simulations += evaluator.stats.simulations
+                if metrics is not None:
+                    self._end_generation(self.generation, evaluator, cache, self.evaluation_seconds)
+                print('Generation {}'.format(self.generation))
+                if self.results_path is None:
+                    print('Best actions: {}'.format([int(action) for action in self.best_individual.actions]))
+                if cache is not None:
+                    print('Cache hits: {}, misses: {}'.format(cache.hits, cache.misses))
+                stats = evaluator.stats
+                if self.racing:
+                    print('Pruned: {}, physics steps skipped: {} (~{:.2f}s CPU saved)'.format(
+                        stats.pruned, stats.steps_skipped, stats.seconds_saved()))
+                if self.surrogate is not None:
+                    print('Surrogate skipped: {} ({} simulations saved), rank agreement: {:.2f}, mean abs error: {:.1f}'
+                          .format(self.surrogate.skipped, self.surrogate.simulations_saved,
+                                  self.surrogate.rank_agreement, self.surrogate.mean_absolute_error))
+                if screener is not None:
+                    print('Screened: {}, confirmed: {}, rank agreement: {:.2f}, coarse {:.2f}s / fine {:.2f}s'.format(
+                        screener.coarse_stats.simulations, screener.confirmed, screener.rank_agreement,
+                        screener.coarse_stats.seconds, stats.seconds))
+                print('Best score: {}\n'.format(int(self.best_individual.score)))
+        finally:
+            evaluator.close()
+            self.close()
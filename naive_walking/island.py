@@ -0,0 +1,303 @@
+from universe import Figure
+from population import Population
+from ga import GeneticAlgorithm, Individual
+from typing import Dict, List, Sequence, Tuple
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import socket
+import struct
+import threading
+
+# a migrant is a list of actions and the score it got on its home island, the receiving island simulates it again
+Migrant = Tuple[List[int], float]
+
+TOPOLOGIES = ('ring', 'fully_connected')
+
+
+def neighbours(island_id: int, num_islands: int, topology: str = 'ring') -> List[int]:
+    """Islands that island_id sends its migrants to"""
+    if topology == 'ring':
+        return [(island_id + 1) % num_islands] if num_islands > 1 else []
+    if topology == 'fully_connected':
+        return [other for other in range(num_islands) if other != island_id]
+    raise ValueError('Unknown topology {}, use one of {}'.format(topology, TOPOLOGIES))
+
+
+class QueueTransport:
+    """Moves migrants between islands running as processes on one machine
+
+    Every island owns an inbox, a multiprocessing queue, and puts its
+    migrants into the inboxes of its neighbours.
+    """
+    def __init__(self, island_id: int, inboxes: Sequence[multiprocessing.Queue]):
+        self.island_id = island_id
+        self.inboxes = inboxes
+
+    def send(self, destination: int, migrants: List[Migrant]) -> None:
+        self.inboxes[destination].put(migrants)
+
+    def receive(self) -> List[Migrant]:
+        """Returns all migrants that arrived since the last call, without waiting"""
+        migrants = []
+        while True:
+            try:
+                migrants.extend(self.inboxes[self.island_id].get_nowait())
+            except queue.Empty:
+                return migrants
+
+    def close(self) -> None:
+        # migrants left in the queues of finished islands must not keep this process from exiting
+        for inbox in self.inboxes:
+            inbox.cancel_join_thread()
+
+
+class TcpTransport:
+    """Moves migrants between islands over plain TCP sockets, e.g. on several machines
+
+    addresses[i] is the (host, port) island i listens on. A background thread
+    accepts connections and queues the incoming migrants, connections to the
+    neighbours are opened on the first send and kept. Messages are JSON,
+    prefixed with their length.
+    """
+    def __init__(self, island_id: int, addresses: Sequence[Tuple[str, int]], timeout: float = 10.0):
+        self.island_id = island_id
+        self.addresses = addresses
+        self.timeout = timeout
+        self._inbox = queue.Queue()
+        self._connections: Dict[int, socket.socket] = {}
+        self._server = socket.create_server(('', addresses[island_id][1]))
+        self._closed = False
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while not self._closed:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._read, args=(connection,), daemon=True).start()
+
+    def _read(self, connection: socket.socket) -> None:
+        with connection:
+            while True:
+                header = _receive_exactly(connection, 4)
+                if header is None:
+                    return
+                body = _receive_exactly(connection, struct.unpack('!I', header)[0])
+                if body is None:
+                    return
+                self._inbox.put([(actions, score) for actions, score in json.loads(body.decode())])
+
+    def send(self, destination: int, migrants: List[Migrant]) -> None:
+        """Sends the migrants, they are dropped if the destination cannot be reached"""
+        body = json.dumps([[[int(action) for action in actions], float(score)] for actions, score in migrants])
+        try:
+            connection = self._connections.get(destination)
+            if connection is None:
+                connection = socket.create_connection(self.addresses[destination], timeout=self.timeout)
+                self._connections[destination] = connection
+            connection.sendall(struct.pack('!I', len(body)) + body.encode())
+        except OSError:
+            # not started yet or already finished, the next migration tries again
+            connection = self._connections.pop(destination, None)
+            if connection is not None:
+                connection.close()
+
+    def receive(self) -> List[Migrant]:
+        """Returns all migrants that arrived since the last call, without waiting"""
+        migrants = []
+        while True:
+            try:
+                migrants.extend(self._inbox.get_nowait())
+            except queue.Empty:
+                return migrants
+
+    def close(self) -> None:
+        self._closed = True
+        self._server.close()
+        for connection in self._connections.values():
+            connection.close()
+
+
+def _receive_exactly(connection: socket.socket, size: int):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class Migration:
+    """Exchanges the best individuals of an island with its neighbours
+
+    Every interval generations the num_migrants best individuals are sent to
+    every neighbour. Arrived migrants replace the last individuals of the
+    next generation, never its elites, and are simulated there like any
+    offspring: their score on the home island is not used, as it is only
+    comparable if both islands run with the same simulation, racing and
+    screening settings. Migration never waits for other islands.
+    """
+    def __init__(
+            self,
+            transport,  # QueueTransport, TcpTransport or any object with send() and receive()
+            destinations: Sequence[int],
+            interval: int = 5,  # generations between two migrations
+            num_migrants: int = 2  # individuals sent to every neighbour
+    ):
+
+        self.transport = transport
+        self.destinations = destinations
+        self.interval = interval
+        self.num_migrants = num_migrants
+        self.sent = 0
+        self.received = 0
+
+    def exchange(self, generation: int, population_sorted, next_population, num_elites: int = 0) -> None:
+        """Sends the best of the sorted population and puts arrived migrants into the next one
+
+        At most the individuals after the num_elites first ones of
+        next_population are replaced, further migrants are dropped.
+        """
+        if generation % self.interval == 0:
+            migrants = [([int(action) for action in individual.actions], float(individual.score))
+                        for individual in list(population_sorted)[:self.num_migrants]]
+            for destination in self.destinations:
+                self.transport.send(destination, migrants)
+                self.sent += len(migrants)
+        immigrants = self.transport.receive()[:max(0, len(next_population) - num_elites)]
+        if immigrants:
+            self.received += len(immigrants)
+            _replace_last(next_population, immigrants)
+
+
+def _replace_last(population, immigrants: List[Migrant]) -> None:
+    first = len(population) - len(immigrants)
+    if isinstance(population, Population):
+        for offset, (actions, _) in enumerate(immigrants):
+            population.actions[first + offset] = actions
+        return
+    for offset, (actions, _) in enumerate(immigrants):
+        population[first + offset] = Individual(list(actions))
+
+
+def run_island(
+        island_id: int,
+        transport,
+        destinations: Sequence[int],
+        ga_settings: Dict,
+        interval: int = 5,
+        num_migrants: int = 2,
+        seed: int = None,
+        quiet: bool = False  # hides the per-generation output of the GA
+) -> Migrant:
+    """Runs the GA of one island and returns its best individual"""
+    if seed is not None:
+        random.seed(seed + island_id)
+        ga_settings = dict(ga_settings, seed=seed + island_id)
+    else:
+        # forked islands inherit the state of the parent, they must not draw the same individuals
+        random.seed()
+    if ga_settings.get('results_path') is not None:
+        # every island keeps its own results, in a subdirectory
+        ga_settings = dict(ga_settings, results_path=os.path.join(ga_settings['results_path'],
+                                                                  'island{}'.format(island_id)))
+    migration = Migration(transport, destinations, interval, num_migrants)
+    ga = GeneticAlgorithm(figure=Figure(), migration=migration, **ga_settings)
+    try:
+        if quiet:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                ga.run()
+        else:
+            ga.run()
+    finally:
+        transport.close()
+    return [int(action) for action in ga.best_individual.actions], float(ga.best_individual.score)
+
+
+def _island_process(island_id, inboxes, destinations, ga_settings, interval, num_migrants, seed, results) -> None:
+    transport = QueueTransport(island_id, inboxes)
+    best = run_island(island_id, transport, destinations, ga_settings, interval, num_migrants, seed,
+                      quiet=island_id != 0)
+    results.put((island_id, best))
+
+
+def run_islands(
+        num_islands: int,
+        ga_settings: Dict,  # arguments of GeneticAlgorithm except figure, e.g. population_size
+        interval: int = 5,
+        num_migrants: int = 2,
+        topology: str = 'ring',
+        seed: int = None  # island i is seeded with seed + i
+) -> List[Migrant]:
+    """Runs num_islands islands as processes on this machine
+
+    Islands exchange migrants over multiprocessing queues. Only island 0
+    prints its progress. Returns the best individual of every island.
+    """
+    inboxes = [multiprocessing.Queue() for _ in range(num_islands)]
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_island_process, args=(
+            island_id, inboxes, neighbours(island_id, num_islands, topology), ga_settings, interval,
+            num_migrants, seed, results))
+        for island_id in range(num_islands)
+    ]
+    for process in processes:
+        process.start()
+    best = {}
+    while len(best) < num_islands:
+        try:
+            island_id, island_best = results.get(timeout=1.0)
+            best[island_id] = island_best
+        except queue.Empty:
+            failed = [process for process in processes if process.exitcode not in (None, 0)]
+            if failed:
+                for process in processes:
+                    process.terminate()
+                raise RuntimeError('An island process failed with exit code {}'.format(failed[0].exitcode))
+    for process in processes:
+        process.join()
+    return [best[island_id] for island_id in range(num_islands)]
+
+
+def _parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+# one island per call, e.g. on two machines:
+#   python island.py --id 0 --addresses hostA:5000 hostB:5000
+#   python island.py --id 1 --addresses hostA:5000 hostB:5000
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs one island of an island-model GA over TCP')
+    parser.add_argument('--id', type=int, required=True, help='index of this island in --addresses')
+    parser.add_argument('--addresses', nargs='+', required=True, help='host:port of every island')
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='ring')
+    parser.add_argument('--interval', type=int, default=5, help='generations between migrations')
+    parser.add_argument('--migrants', type=int, default=2, help='individuals sent to every neighbour')
+    parser.add_argument('--population-size', type=int, default=100)
+    parser.add_argument('--generations', type=int, default=50)
+    parser.add_argument('--runtime', type=int, default=18)
+    parser.add_argument('--moves-per-second', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    island_addresses = [_parse_address(address) for address in args.addresses]
+    settings = {
+        'population_size': args.population_size,
+        'num_generations': args.generations,
+        'simulation_runtime': args.runtime,
+        'moves_per_second': args.moves_per_second,
+    }
+    tcp = TcpTransport(args.id, island_addresses)
+    actions, score = run_island(args.id, tcp, neighbours(args.id, len(island_addresses), args.topology), settings,
+                                args.interval, args.migrants, args.seed)
+    print('Island {} best score: {}'.format(args.id, int(score)))
+    print('Best actions: {}'.format(actions))
@@ -1,6 +1,9 @@
 from universe import Figure
-from simulation import Simulation, Display
+from simulation import Simulation
 from ga import GeneticAlgorithm
+from metrics import JsonlMetrics
+from island import run_islands
+import copy
 
 # Pymunk simulation
 # runtime for a single simulation in seconds (e.g. 15 seconds)
@@ -8,36 +11,96 @@ from ga import GeneticAlgorithm
 sim_runtime = 18
 moves_per_second = 3
 
-# Creating the figure out of 3 polygons
-fig = Figure()
-
 # Parameters for genetic algorithm
 population_size = 100  # change this 👈
 num_generations = 50  # change this 👈
 elitism_size = 0.1  # percentage of best individuals that will be used in the next generation
 crossover_size = 0.6  # percentage of individuals that will be created using mutation (crossover)
 crossover_rate = 0.5  # probability of elite feature to be kept in genome
+num_workers = 1  # number of processes simulating the population (None uses all CPUs)
+cache_size = 10000  # number of scores kept in memory, 0 disables the fitness cache
+cache_path = None  # e.g. 'fitness.sqlite' to keep scores across runs
+vectorized = False  # keep the population in numpy arrays, faster for very large populations
+racing = False  # stop simulations early once they can no longer become elites
+screening = None  # e.g. evaluation.Screening(fraction=0.3, fps=1/15, iterations=5) to pre-screen at a coarse fidelity
+surrogate = None  # e.g. surrogate.Surrogate(fraction=0.5) to simulate the most promising half of the offspring
+steady_state = False  # no generations, a new offspring is simulated as soon as a worker is free
+checkpoint_path = None  # e.g. 'run.npz' to save the run after every generation
+resume = False  # continue the run saved at checkpoint_path instead of starting a new one
+num_islands = 1  # populations evolving in parallel processes, exchanging their best individuals
+migration_interval = 5  # generations between two migrations
+num_migrants = 2  # best individuals sent to every neighbouring island
+topology = 'ring'  # or 'fully_connected'
+results_path = None  # e.g. 'results' to keep every genome and score on disk instead of printing the best genome
+metrics_path = None  # e.g. 'metrics.jsonl' to write per-phase timings of every generation
+playback_speed = 1.0  # the best individual is recorded once and played back, 2.0 plays twice as fast
+trajectory_path = None  # e.g. 'best.npy' to keep the recorded trajectory
+video_path = None  # e.g. 'best.gif', 'best.mp4' or a directory for PNG frames, written offscreen instead of displaying
+
+# the guard keeps worker processes from re-running the GA when they import this module
+if __name__ == '__main__':
+    # Creating the figure out of 3 polygons
+    fig = Figure()
+
+    # Running Genetic algorithm with our figure
+    print('---Running GA for {} generations---'.format(num_generations))
+
+    settings = dict(population_size=population_size,
+                    num_generations=num_generations,
+                    simulation_runtime=sim_runtime,
+                    crossover_rate=crossover_rate,
+                    elitism_size=elitism_size,
+                    crossover_size=crossover_size,
+                    moves_per_second=moves_per_second,
+                    num_workers=num_workers,
+                    cache_size=cache_size,
+                    cache_path=cache_path,
+                    vectorized=vectorized,
+                    racing=racing,
+                    steady_state=steady_state,
+                    screening=screening,
+                    surrogate=surrogate,
+                    results_path=results_path,
+                    )
+    if num_islands > 1:
+        # every island is a process, the islands only report their best individuals
+        islands = run_islands(num_islands, settings, migration_interval, num_migrants, topology)
+        best_actions, _ = min(islands, key=lambda island: island[1])
+    else:
+        metrics = JsonlMetrics(metrics_path) if metrics_path is not None else None
+        ga = GeneticAlgorithm(figure=fig, checkpoint_path=checkpoint_path, metrics=metrics, **settings)
+        try:
+            if resume:
+                ga.resume()
+            else:
+                ga.run()
+        finally:
+            if metrics is not None:
+                metrics.close()
+        best_actions = ga.best_individual.actions
+
+    # Recording the best individual once, the display plays the frames back without physics
+    # a copy, the display builds a universe of its own with the figure
+    best = Simulation(best_actions, copy.deepcopy(fig), sim_runtime)
+    best.run(record=True)
+    if trajectory_path is not None:
+        best.trajectory.save(trajectory_path)
+
+    if video_path is not None:
+        # no window and no waiting, the frames are drawn as fast as the CPU allows
+        from render import write_video
+        num_frames = write_video(best.trajectory, fig, video_path)
+        print('Wrote {} frames to {}'.format(num_frames, video_path))
+    else:
+        # Displaying simulation with best individual calculated by GA
+        # imported here, spawned worker processes re-import this module and must not need pyglet or a display
+        from display import Display
+        label = 'Generation ' + str(num_generations)
+        d = Display(best_actions, fig, label, sim_runtime, trajectory=best.trajectory, speed=playback_speed)
 
-# Running Genetic algorithm with our figure
-print('---Running GA for {} generations---'.format(num_generations))
-
-ga = GeneticAlgorithm(figure=fig,
-                      population_size=population_size,
-                      num_generations=num_generations,
-                      simulation_runtime=sim_runtime,
-                      crossover_rate=crossover_rate,
-                      elitism_size=elitism_size,
-                      moves_per_second=moves_per_second,
-                      )
-ga.run()
-best_actions = ga.best_individual.actions
-
-# Displaying simulation with best individual calculated by GA
-label = 'Generation ' + str(num_generations)
-d = Display(best_actions, fig, label, sim_runtime)
-
-print('----Displaying best individual----')
-start_display = input("Enter 'S' to display: ")
-if start_display.lower() == 's':
-    d.display_simulation()
-print('Score: {}'.format(int(d.get_score())))
+        print('----Displaying best individual----')
+        print('Arrow keys: left/right to seek, up/down to change the speed, space to pause')
+        start_display = input("Enter 'S' to display: ")
+        if start_display.lower() == 's':
+            d.display_simulation()
+    print('Score: {}'.format(int(best.evaluate())))
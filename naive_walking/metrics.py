@@ -0,0 +1,80 @@
+from collections import defaultdict
+from typing import Dict, List
+import json
+import time
+
+
+class Metrics:
+    """In-process sink for per-phase timings and counters
+
+    Simulations and the GA add the seconds spent in each phase (see PHASES)
+    and count events while a generation runs. end_generation() turns them into
+    a record, appends it to self.records, adds it to the totals and hands it to
+    emit(), which subclasses override to send the record elsewhere.
+    Everything that can be instrumented takes metrics=None, and then skips
+    the clock calls entirely.
+    """
+    PHASES = ('setup', 'step', 'actions', 'overlap', 'sort', 'reproduction')
+
+    def __init__(self):
+        self.records: List[Dict] = []
+        self.totals: Dict[str, float] = defaultdict(float)  # phases and counters of all generations
+        self.phases: Dict[str, float] = defaultdict(float)  # seconds per phase in the current generation
+        self.counters: Dict[str, int] = defaultdict(int)  # events in the current generation
+        self._generation_start = time.perf_counter()
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] += seconds
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        self.counters[counter] += amount
+
+    def merge(self, phases: Dict[str, float], counters: Dict[str, int]) -> None:
+        """Adds phases and counters collected elsewhere, e.g. in a worker process"""
+        for phase, seconds in phases.items():
+            self.phases[phase] += seconds
+        for counter, amount in counters.items():
+            self.counters[counter] += amount
+
+    def start_generation(self) -> None:
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+        self._generation_start = time.perf_counter()
+
+    def end_generation(self, generation: int, **values) -> Dict:
+        """Closes the current generation, values are added to its record as they are"""
+        wall_seconds = time.perf_counter() - self._generation_start
+        record = {'generation': generation, 'wall_seconds': wall_seconds}
+        record['phases'] = {phase: self.phases.get(phase, 0.0) for phase in self.PHASES}
+        record['phases'].update(self.phases)
+        record['counters'] = dict(self.counters)
+        record.update(values)
+        for phase, seconds in self.phases.items():
+            self.totals[phase] += seconds
+        for counter, amount in self.counters.items():
+            self.totals[counter] += amount
+        self.totals['wall_seconds'] += wall_seconds
+        self.records.append(record)
+        self.emit(record)
+        return record
+
+    def emit(self, record: Dict) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class JsonlMetrics(Metrics):
+    """Writes every generation record as one JSON line to a file"""
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._file = open(path, 'a')
+
+    def emit(self, record: Dict) -> None:
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,119 @@
+from typing import Iterator
+import numpy as np
+
+
+class IndividualView:
+    """Individual backed by one row of a Population
+
+    Has the same attributes as ga.Individual, reading and writing the
+    actions and the score goes straight to the arrays of the population.
+    """
+    __slots__ = ('_population', '_index')
+
+    def __init__(self, population: 'Population', index: int):
+        self._population = population
+        self._index = index
+
+    @property
+    def actions(self) -> np.ndarray:
+        return self._population.actions[self._index]
+
+    @property
+    def score(self) -> float:
+        return float(self._population.scores[self._index])
+
+    @score.setter
+    def score(self, score: float) -> None:
+        self._population.scores[self._index] = score
+
+    @property
+    def pruned(self) -> bool:
+        return bool(self._population.pruned[self._index])
+
+    @pruned.setter
+    def pruned(self, pruned: bool) -> None:
+        self._population.pruned[self._index] = pruned
+
+    def set_score(self, score: float) -> None:
+        self.score = score
+
+
+class Population:
+    """Population stored as a matrix of actions and a vector of scores
+
+    Row i of actions (int8, one column per action), scores[i] and pruned[i]
+    (simulation stopped early) belong to individual i. The genetic operators
+    work on whole matrices at once instead of looping over individuals and
+    actions in Python.
+    """
+    def __init__(self, actions: np.ndarray, scores: np.ndarray = None, pruned: np.ndarray = None):
+        self.actions = np.asarray(actions, dtype=np.int8)
+        if scores is None:
+            scores = np.zeros(len(self.actions))
+        if pruned is None:
+            pruned = np.zeros(len(self.actions), dtype=bool)
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self.pruned = np.asarray(pruned, dtype=bool)
+
+    @classmethod
+    def random(
+            cls,
+            population_size: int,
+            individual_size: int,
+            rng: np.random.Generator,
+            num_moves: int = 4  # actions are drawn from 0 to num_moves - 1
+    ) -> 'Population':
+        actions = rng.integers(0, num_moves, size=(population_size, individual_size), dtype=np.int8)
+        return cls(actions)
+
+    @classmethod
+    def concatenate(cls, *populations: 'Population') -> 'Population':
+        return cls(
+            np.concatenate([population.actions for population in populations]),
+            np.concatenate([population.scores for population in populations]),
+            np.concatenate([population.pruned for population in populations])
+        )
+
+    def sort(self) -> None:
+        """Sorts the individuals by score, lowest (best) first"""
+        order = np.argsort(self.scores, kind='stable')
+        self.actions = self.actions[order]
+        self.scores = self.scores[order]
+        self.pruned = self.pruned[order]
+
+    def elites(self, num_elites: int) -> 'Population':
+        """Returns a copy of the first num_elites individuals of a sorted population"""
+        return Population(
+            self.actions[:num_elites].copy(), self.scores[:num_elites].copy(), self.pruned[:num_elites].copy()
+        )
+
+    def crossover(
+            self,
+            num_elites: int,
+            num_crossovers: int,
+            crossover_rate: float,
+            rng: np.random.Generator
+    ) -> 'Population':
+        """Performs uniform crossover between random elites and random non-elites
+
+        Same operator as GeneticAlgorithm.crossover for a sorted population,
+        every action of the offspring comes from the elite with probability
+        crossover_rate.
+        """
+        elite = self.actions[rng.integers(0, num_elites, size=num_crossovers)]
+        non_elite = self.actions[rng.integers(num_elites, len(self), size=num_crossovers)]
+        take_non_elite = rng.random(elite.shape) > crossover_rate
+        return Population(np.where(take_non_elite, non_elite, elite))
+
+    def __len__(self) -> int:
+        return len(self.actions)
+
+    def __getitem__(self, index: int) -> IndividualView:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('population index out of range')
+        return IndividualView(self, index)
+
+    def __iter__(self) -> Iterator[IndividualView]:
+        return (IndividualView(self, index) for index in range(len(self)))
@@ -0,0 +1,388 @@
+from universe import Universe, Figure
+from simulation import Simulation
+from trajectory import Trajectory
+from results import ResultReader
+from typing import List, Sequence, Tuple
+import argparse
+import copy
+import multiprocessing
+import os
+import shutil
+import struct
+import subprocess
+import time
+import zlib
+import numpy as np
+import pymunk
+
+# frames are palette indices into this table
+PALETTE = np.array([
+    (0, 0, 0),  # background, like the window
+    (200, 200, 200),  # walls
+    (66, 135, 245),  # center polygon
+    (245, 166, 35),  # legs
+    (220, 60, 60),  # obstacle
+    (255, 255, 255),  # obstacle spoke, shows its rotation
+    (0, 0, 0),
+    (0, 0, 0),  # transparent in GIF frames, marks pixels unchanged since the previous frame
+], dtype=np.uint8)
+BACKGROUND, WALL, CENTER, LEG, OBSTACLE, SPOKE = range(6)
+TRANSPARENT = 7
+FORMATS = ('gif', 'mp4', 'png')
+
+
+class Renderer:
+    """Draws poses of a universe into frames with numpy, without a window or OpenGL
+
+    A frame is a (height, width) uint8 array of PALETTE indices, drawn like
+    Display draws the space: the walls, the three polygons of the figure and
+    the obstacle. The walls are drawn once, every frame only fills the
+    moving shapes within their bounding boxes. scale is pixels per unit,
+    0.5 renders at half the window size.
+    """
+    def __init__(self, figure: Figure, scale: float = 1.0, width: int = 1000, height: int = 400):
+        self.scale = scale
+        self.world_height = height
+        self.width = int(round(width * scale))
+        self.height = int(round(height * scale))
+        # a copy, the figure may already be simulated in another universe
+        figure = copy.deepcopy(figure)
+        self.universe = Universe(figure)
+        self._background = np.full((self.height, self.width), BACKGROUND, dtype=np.uint8)
+        self._shapes = []  # moving shapes and their colour
+        for shape in self.universe.space.shapes:
+            if shape.body.body_type == pymunk.Body.STATIC:
+                self._fill_capsule(self._background, shape.a, shape.b, shape.radius, WALL)
+            elif isinstance(shape, pymunk.Circle):
+                self._shapes.append((shape, OBSTACLE))
+            else:
+                self._shapes.append((shape, CENTER if shape.body is figure.center_poly.body else LEG))
+
+    def render(self, pose) -> np.ndarray:
+        """Returns the frame of a pose, see Universe.get_pose"""
+        self.universe.set_pose(pose)
+        frame = self._background.copy()
+        for shape, colour in self._shapes:
+            body = shape.body
+            if isinstance(shape, pymunk.Circle):
+                center = body.local_to_world(shape.offset)
+                self._fill_capsule(frame, center, center, shape.radius, colour)
+                rim = body.local_to_world(shape.offset + pymunk.Vec2d(shape.radius, 0))
+                self._fill_capsule(frame, center, rim, 1.0, SPOKE)
+            else:
+                self._fill_polygon(frame, [body.local_to_world(vertex) for vertex in shape.get_vertices()], colour)
+        return frame
+
+    def frames(self, trajectory: Trajectory, frame_step: int = 1):
+        """Yields the frames of every frame_step-th pose of a trajectory"""
+        for pose in trajectory.frames[::frame_step]:
+            yield self.render(pose)
+
+    def _grid(self, left: float, bottom: float, right: float, top: float):
+        """Rows, columns and world coordinates of the pixel centres within a bounding box"""
+        first_column = max(0, int(left * self.scale))
+        last_column = min(self.width, int(right * self.scale) + 1)
+        first_row = max(0, int((self.world_height - top) * self.scale))
+        last_row = min(self.height, int((self.world_height - bottom) * self.scale) + 1)
+        if first_column >= last_column or first_row >= last_row:
+            return None
+        xs = (np.arange(first_column, last_column) + 0.5) / self.scale
+        ys = self.world_height - (np.arange(first_row, last_row) + 0.5)[:, None] / self.scale
+        return slice(first_row, last_row), slice(first_column, last_column), xs, ys
+
+    def _fill_polygon(self, frame: np.ndarray, points: Sequence, colour: int) -> None:
+        """Fills a convex polygon"""
+        points = np.array([tuple(point) for point in points])
+        grid = self._grid(*points.min(axis=0), *points.max(axis=0))
+        if grid is None:
+            return
+        rows, columns, xs, ys = grid
+        inside = np.ones((len(ys), len(xs)), dtype=bool)
+        # counter-clockwise with a positive area, the sign makes both orientations work
+        x, y = points[:, 0], points[:, 1]
+        orientation = np.sign(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) or 1.0
+        for (x0, y0), (x1, y1) in zip(points, np.roll(points, -1, axis=0)):
+            inside &= orientation * ((x1 - x0) * (ys - y0) - (y1 - y0) * (xs - x0)) >= 0
+        frame[rows, columns][inside] = colour
+
+    def _fill_capsule(self, frame: np.ndarray, a, b, radius: float, colour: int) -> None:
+        """Fills every pixel within radius of the segment from a to b, a disk if a == b"""
+        (ax, ay), (bx, by) = tuple(a), tuple(b)
+        radius = max(radius, 0.5 / self.scale)  # at least one pixel wide
+        grid = self._grid(min(ax, bx) - radius, min(ay, by) - radius, max(ax, bx) + radius, max(ay, by) + radius)
+        if grid is None:
+            return
+        rows, columns, xs, ys = grid
+        dx, dy = bx - ax, by - ay
+        length = dx * dx + dy * dy
+        t = np.clip(((xs - ax) * dx + (ys - ay) * dy) / length, 0.0, 1.0) if length > 0 else 0.0
+        inside = (xs - ax - t * dx) ** 2 + (ys - ay - t * dy) ** 2 <= radius * radius
+        frame[rows, columns][inside] = colour
+
+
+def _chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def write_png(path: str, frame: np.ndarray, level: int = 6) -> None:
+    """Writes a frame as an 8-bit palette PNG"""
+    height, width = frame.shape
+    rows = np.zeros((height, width + 1), dtype=np.uint8)  # every row starts with filter type 0
+    rows[:, 1:] = frame
+    with open(path, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+        file.write(_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)))
+        file.write(_chunk(b'PLTE', PALETTE.tobytes()))
+        file.write(_chunk(b'IDAT', zlib.compress(rows.tobytes(), level)))
+        file.write(_chunk(b'IEND', b''))
+
+
+def _lzw(pixels: bytes, min_code_size: int) -> bytes:
+    """GIF flavour of LZW: variable code width up to 12 bits, least significant bit first"""
+    clear = 1 << min_code_size
+    end = clear + 1
+    output = bytearray()
+    buffer = bits = 0
+    code_size = min_code_size + 1
+    table = {}
+    next_code = end + 1
+    buffer |= clear << bits
+    bits += code_size
+    prefix = pixels[0]
+    for pixel in pixels[1:]:
+        key = (prefix << 8) | pixel
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        buffer |= prefix << bits
+        bits += code_size
+        while bits >= 8:
+            output.append(buffer & 0xff)
+            buffer >>= 8
+            bits -= 8
+        table[key] = next_code
+        next_code += 1
+        # the decoder adds its entry one code later, hence the + 1
+        if next_code > (1 << code_size) and code_size < 12:
+            code_size += 1
+        if next_code == 4096:
+            buffer |= clear << bits
+            bits += code_size
+            table = {}
+            next_code = end + 1
+            code_size = min_code_size + 1
+        prefix = pixel
+    buffer |= prefix << bits
+    bits += code_size
+    # the decoder adds an entry for the last code before it reads the end code
+    next_code += 1
+    if next_code > (1 << code_size) and code_size < 12:
+        code_size += 1
+    buffer |= end << bits
+    bits += code_size
+    while bits > 0:
+        output.append(buffer & 0xff)
+        buffer >>= 8
+        bits -= 8
+    return bytes(output)
+
+
+class GifWriter:
+    """Writes frames to a looping animated GIF
+
+    After the first frame only the bounding box of the pixels that changed
+    is stored, with the unchanged pixels in it transparent, so a frame costs
+    the area the figure and the obstacle moved over instead of the window.
+    """
+    def __init__(self, path: str, width: int, height: int, fps: float):
+        self.delay = max(2, int(round(100 / fps)))  # centiseconds, viewers slow down anything below 2
+        self._previous: np.ndarray = None
+        self._file = open(path, 'wb')
+        self._file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0xf2, 0, 0))  # 8 colours of 8 bits
+        self._file.write(PALETTE.tobytes())
+        self._file.write(b'!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')  # loop forever
+
+    def write(self, frame: np.ndarray) -> None:
+        top, left = 0, 0
+        transparent = 0
+        if self._previous is not None:
+            changed = frame != self._previous
+            rows, columns = np.nonzero(changed.any(axis=1))[0], np.nonzero(changed.any(axis=0))[0]
+            if len(rows) == 0:
+                top, bottom, left, right = 0, 1, 0, 1
+            else:
+                top, bottom, left, right = rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+            image = np.where(changed[top:bottom, left:right], frame[top:bottom, left:right], TRANSPARENT)
+            transparent = 1
+        else:
+            image = frame
+        self._previous = frame
+        height, width = image.shape
+        # graphic control: keep the previous frame below, delay and transparency
+        self._file.write(b'!\xf9\x04' + struct.pack('<BHB', (1 << 2) | transparent, self.delay, TRANSPARENT) + b'\x00')
+        self._file.write(b',' + struct.pack('<HHHHB', left, top, width, height, 0))
+        data = _lzw(np.ascontiguousarray(image, dtype=np.uint8).tobytes(), 3)
+        self._file.write(b'\x03')
+        for start in range(0, len(data), 255):
+            block = data[start:start + 255]
+            self._file.write(bytes([len(block)]) + block)
+        self._file.write(b'\x00')
+
+    def close(self) -> None:
+        self._file.write(b';')
+        self._file.close()
+
+
+class Mp4Writer:
+    """Pipes RGB frames to ffmpeg, which has to be on the PATH"""
+    def __init__(self, path: str, width: int, height: int, fps: float):
+        if shutil.which('ffmpeg') is None:
+            raise RuntimeError('MP4 export needs ffmpeg on the PATH, write a GIF or PNG frames instead')
+        self._process = subprocess.Popen([
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(width, height), '-r', str(fps), '-i', '-',
+            # yuv420p plays everywhere but needs an even width and height
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', '-vcodec', 'libx264', path
+        ], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, frame: np.ndarray) -> None:
+        self._process.stdin.write(PALETTE[frame].tobytes())
+
+    def close(self) -> None:
+        self._process.stdin.close()
+        error = self._process.stderr.read()
+        if self._process.wait() != 0:
+            raise RuntimeError('ffmpeg failed: {}'.format(error.decode(errors='replace')))
+
+
+class PngWriter:
+    """Writes every frame to its own PNG in a directory, frame_00000.png and so on"""
+    def __init__(self, path: str, width: int, height: int, fps: float):
+        self.path = path
+        self.count = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, frame: np.ndarray) -> None:
+        write_png(os.path.join(self.path, 'frame_{:05d}.png'.format(self.count)), frame)
+        self.count += 1
+
+    def close(self) -> None:
+        pass
+
+
+def open_video(path: str, width: int, height: int, fps: float):
+    """GifWriter or Mp4Writer by the extension of path, a PngWriter for a directory otherwise"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.gif':
+        return GifWriter(path, width, height, fps)
+    if extension == '.mp4':
+        return Mp4Writer(path, width, height, fps)
+    return PngWriter(path, width, height, fps)
+
+
+def write_video(
+        trajectory: Trajectory,
+        figure: Figure,
+        path: str,  # .gif, .mp4 or a directory for PNG frames
+        scale: float = 1.0,  # pixels per unit, 1.0 is the window size
+        frame_step: int = 1  # keep every n-th physics step, the video plays at real time anyway
+) -> int:
+    """Draws a recorded trajectory as fast as possible and writes it, returns the number of frames"""
+    renderer = Renderer(figure, scale)
+    video = open_video(path, renderer.width, renderer.height, 1.0 / (trajectory.fps * frame_step))
+    count = 0
+    try:
+        for frame in renderer.frames(trajectory, frame_step):
+            video.write(frame)
+            count += 1
+    finally:
+        video.close()
+    return count
+
+
+def export(
+        actions: List[int],
+        figure: Figure,
+        runtime: float,
+        path: str,
+        scale: float = 1.0,
+        frame_step: int = 1
+) -> Tuple[float, int]:
+    """Simulates an action list once, recording it, and writes the video, returns the score and frames"""
+    simulation = Simulation(actions, copy.deepcopy(figure), runtime)
+    simulation.run(record=True)
+    return simulation.score, write_video(simulation.trajectory, figure, path, scale, frame_step)
+
+
+def _export_task(task: Tuple) -> Tuple[str, float, int, float]:
+    actions, figure, runtime, path, scale, frame_step = task
+    start = time.perf_counter()
+    score, frames = export(actions, figure, runtime, path, scale, frame_step)
+    return path, score, frames, time.perf_counter() - start
+
+
+def export_top(
+        results_paths: Sequence[str],  # directories written by results.ResultWriter
+        output_path: str,
+        top: int = 1,  # best distinct individuals of every run
+        video_format: str = 'gif',  # one of FORMATS
+        figure: Figure = None,  # defaults to Figure()
+        runtime: float = None,  # needed for logs that do not store it
+        num_workers: int = 1,  # processes rendering videos in parallel, None for all CPUs
+        scale: float = 1.0,
+        frame_step: int = 1
+) -> List[Tuple[str, float, int, float]]:
+    """Writes videos of the top individuals of every run to output_path
+
+    Videos are named after the run directory, the rank and the score, e.g.
+    results_1_652.gif. Every video is simulated and drawn in one task, the
+    tasks run on num_workers processes. Returns the path, score, frames and
+    seconds of every video in the order they were finished.
+    """
+    if video_format not in FORMATS:
+        raise ValueError('Unknown video format {}, use one of {}'.format(video_format, FORMATS))
+    figure = figure if figure is not None else Figure()
+    os.makedirs(output_path, exist_ok=True)
+    tasks = []
+    for results_path in results_paths:
+        reader = ResultReader(results_path)
+        run_runtime = reader.runtime if reader.runtime is not None else runtime
+        if run_runtime is None:
+            raise ValueError('{} does not store the simulation runtime, pass runtime'.format(results_path))
+        name = os.path.basename(os.path.normpath(results_path))
+        for rank, (_, actions, score) in enumerate(reader.top(top), 1):
+            file_name = '{}_{}_{}'.format(name, rank, int(score))
+            if video_format != 'png':
+                file_name += '.' + video_format
+            tasks.append(([int(action) for action in actions], figure, run_runtime,
+                          os.path.join(output_path, file_name), scale, frame_step))
+    if num_workers == 1:
+        return [_export_task(task) for task in tasks]
+    with multiprocessing.Pool(num_workers) as pool:
+        return list(pool.imap_unordered(_export_task, tasks))
+
+
+# the guard keeps worker processes from rendering again when they import this module
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes videos of the best individuals of result logs, no display')
+    parser.add_argument('results', nargs='+', help='directories written with results_path')
+    parser.add_argument('--output', default='videos', help='directory the videos are written to')
+    parser.add_argument('--top', type=int, default=1, help='best distinct individuals per run (default 1)')
+    parser.add_argument('--format', choices=FORMATS, default='gif')
+    parser.add_argument('--workers', type=int, default=1, help='rendering processes, 0 for all CPUs')
+    parser.add_argument('--scale', type=float, default=1.0, help='pixels per unit, 0.5 is half the window size')
+    parser.add_argument('--frame-step', type=int, default=1, help='keep every n-th frame (default 1)')
+    parser.add_argument('--runtime', type=float, help='simulation runtime of logs that do not store it')
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    videos = export_top(args.results, args.output, args.top, args.format, runtime=args.runtime,
+                        num_workers=args.workers or None, scale=args.scale, frame_step=args.frame_step)
+    total_frames = 0
+    for video_path, video_score, num_frames, seconds in videos:
+        total_frames += num_frames
+        print('{}: score {}, {} frames in {:.2f}s ({:.0f} frames/s)'.format(
+            video_path, int(video_score), num_frames, seconds, num_frames / seconds))
+    elapsed = time.perf_counter() - start_time
+    print('{} videos, {} frames in {:.2f}s'.format(len(videos), total_frames, elapsed))
@@ -0,0 +1,159 @@
+from typing import Dict, List, Tuple
+import json
+import os
+import numpy as np
+
+# one raw file per column, every row is one evaluated individual
+_COLUMNS = {
+    'actions': np.int8,
+    'scores': np.float64,
+    'pruned': bool,
+}
+
+
+def _column_path(path: str, column: str) -> str:
+    return os.path.join(path, column + '.bin')
+
+
+def _index_path(path: str) -> str:
+    return os.path.join(path, 'generations.jsonl')
+
+
+def _meta_path(path: str) -> str:
+    return os.path.join(path, 'meta.json')
+
+
+def _read_index(path: str) -> List[Dict]:
+    if not os.path.exists(_index_path(path)):
+        return []
+    with open(_index_path(path)) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+class ResultWriter:
+    """Appends the genomes, scores and timings of every generation to a directory
+
+    Columns are raw binary files (actions as int8 rows of num_actions,
+    scores as float64, pruned flags as bool), so appending a generation is a
+    few writes and the files can be memory-mapped by ResultReader.
+    generations.jsonl holds one line per generation with its first row, row
+    count and timings; it is written after the columns, so a crash never
+    leaves a generation that is only partly on disk.
+    Generations after start_generation already in the directory (e.g. from
+    a run that is being resumed from an older checkpoint) are dropped.
+    runtime is stored so the individuals can be simulated again, see render.
+    """
+    def __init__(self, path: str, num_actions: int, start_generation: int = 0, runtime: float = None):
+        self.path = path
+        self.num_actions = num_actions
+        os.makedirs(path, exist_ok=True)
+        with open(_meta_path(path), 'w') as file:
+            json.dump({'num_actions': num_actions, 'runtime': runtime}, file)
+        self.generations = [record for record in _read_index(path) if record['generation'] <= start_generation]
+        self.rows = sum(record['count'] for record in self.generations)
+        self._truncate()
+        self._files = {column: open(_column_path(path, column), 'ab') for column in _COLUMNS}
+        self._index = open(_index_path(path), 'a')
+
+    def _truncate(self) -> None:
+        for column, dtype in _COLUMNS.items():
+            row_size = np.dtype(dtype).itemsize * (self.num_actions if column == 'actions' else 1)
+            with open(_column_path(self.path, column), 'ab') as file:
+                file.truncate(self.rows * row_size)
+        with open(_index_path(self.path), 'w') as file:
+            for record in self.generations:
+                file.write(json.dumps(record) + '\n')
+
+    def append(
+            self,
+            generation: int,
+            actions: np.ndarray,
+            scores: np.ndarray,
+            pruned: np.ndarray,
+            **timings: float  # e.g. evaluation_seconds, stored in the generation record
+    ) -> None:
+        columns = {'actions': actions, 'scores': scores, 'pruned': pruned}
+        for column, dtype in _COLUMNS.items():
+            self._files[column].write(np.ascontiguousarray(columns[column], dtype=dtype).tobytes())
+            self._files[column].flush()
+        record = {'generation': generation, 'offset': self.rows, 'count': len(scores)}
+        scores = np.asarray(scores, dtype=np.float64)
+        if len(scores):
+            record['best_score'] = float(scores.min())
+        record.update(timings)
+        self._index.write(json.dumps(record) + '\n')
+        self._index.flush()
+        self.generations.append(record)
+        self.rows += len(scores)
+
+    def close(self) -> None:
+        for file in self._files.values():
+            file.close()
+        self._index.close()
+
+
+class ResultReader:
+    """Reads a directory written by ResultWriter, memory-mapped by default
+
+    actions, scores and pruned hold every individual of every generation,
+    generation(n) returns the rows of one generation as views. Only the
+    pages that are used are read, so runs of any size can be analysed.
+    """
+    def __init__(self, path: str, mmap: bool = True):
+        self.path = path
+        with open(_meta_path(path)) as file:
+            meta = json.load(file)
+        self.num_actions = meta['num_actions']
+        self.runtime = meta.get('runtime')  # simulation runtime, not stored by older logs
+        self.generations = _read_index(path)
+        rows = sum(record['count'] for record in self.generations)
+        shapes = {'actions': (rows, self.num_actions), 'scores': (rows,), 'pruned': (rows,)}
+        for column, dtype in _COLUMNS.items():
+            if rows == 0:
+                data = np.empty(shapes[column], dtype=dtype)
+            elif mmap:
+                data = np.memmap(_column_path(path, column), dtype=dtype, mode='r', shape=shapes[column])
+            else:
+                count = int(np.prod(shapes[column]))
+                data = np.fromfile(_column_path(path, column), dtype=dtype, count=count).reshape(shapes[column])
+            setattr(self, column, data)
+        self._by_generation = {record['generation']: record for record in self.generations}
+
+    def __len__(self) -> int:
+        return len(self.generations)
+
+    def generation(self, generation: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Actions, scores and pruned flags of one generation"""
+        record = self._by_generation[generation]
+        rows = slice(record['offset'], record['offset'] + record['count'])
+        return self.actions[rows], self.scores[rows], self.pruned[rows]
+
+    def column(self, name: str) -> np.ndarray:
+        """A value of every generation record, e.g. best_score or evaluation_seconds"""
+        return np.array([record.get(name, np.nan) for record in self.generations], dtype=np.float64)
+
+    def best(self) -> Tuple[int, np.ndarray, float]:
+        """Generation, actions and score of the best individual of the run"""
+        row = int(np.argmin(self.scores))
+        generation = next(record['generation'] for record in self.generations
+                          if record['offset'] <= row < record['offset'] + record['count'])
+        return generation, self.actions[row], float(self.scores[row])
+
+    def top(self, k: int) -> List[Tuple[int, np.ndarray, float]]:
+        """Generation, actions and score of the k best distinct individuals, best first
+
+        Pruned individuals only have a lower bound as score and are left out.
+        """
+        offsets = np.array([record['offset'] for record in self.generations])
+        found = []
+        seen = set()
+        for row in np.argsort(self.scores, kind='stable'):
+            if len(found) == k or not np.isfinite(self.scores[row]):
+                break
+            key = self.actions[row].tobytes()
+            if self.pruned[row] or key in seen:
+                continue
+            seen.add(key)
+            record = self.generations[int(np.searchsorted(offsets, row, side='right')) - 1]
+            found.append((record['generation'], self.actions[row], float(self.scores[row])))
+        return found
@@ -0,0 +1,66 @@
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+
+LEFT_MOTOR, RIGHT_MOTOR = 0, 1
+
+# motor and rate every action sets, see Figure.move_left_poly and Figure.move_right_poly
+ACTION_RATES = {
+    0: (LEFT_MOTOR, 10000.0),  # left up
+    1: (LEFT_MOTOR, -10000.0),  # left down
+    2: (RIGHT_MOTOR, -10000.0),  # right up
+    3: (RIGHT_MOTOR, 10000.0),  # right down
+}
+
+
+@lru_cache(maxsize=64)
+def _timing(num_actions: int, runtime: float, fps: float) -> Tuple[Tuple[float, ...], Tuple[int, ...], Tuple]:
+    """Simulated time after every step, the step every action fires on and the action of every step
+
+    Runs the clock of Simulation.run once without physics: the time is
+    summed step by step in floats, so the steps are exactly the ones of the
+    per-step check current_action < current_time / num_actions_per_second.
+    Only the length of the action list matters, so all lists of a population
+    share the result.
+    """
+    num_actions_per_second = runtime / num_actions
+    times = [0.0]
+    action_steps = []
+    current_time = 0.0
+    current_action = 1
+    while current_time <= runtime:
+        current_time += fps
+        times.append(current_time)
+        if current_action < (current_time / num_actions_per_second):
+            action_steps.append(len(times) - 1)
+            current_action += 1
+    actions_at = [None] * len(times)
+    for index, step in enumerate(action_steps):
+        actions_at[step] = index
+    return tuple(times), tuple(action_steps), tuple(actions_at)
+
+
+class ActionSchedule:
+    """An action list compiled into the steps it acts on and the motor rates it writes
+
+    times[step] is the simulated time after that many steps, num_steps the
+    steps until the runtime is exceeded. actions_at[step] is the index of the
+    action that fires after that step or None. writes[index] is the (motor,
+    rate) the action sets, or None if the motor already runs at that rate
+    because an earlier action of the list set it, so the write is skipped.
+    """
+    def __init__(self, actions: Sequence[int], runtime: float, fps: float = 1.0 / 30):
+        self.times, self.action_steps, self.actions_at = _timing(len(actions), runtime, fps)
+        self.num_steps = len(self.times) - 1
+        self.writes: List[Optional[Tuple[int, float]]] = []
+        rates = [None, None]  # unknown before the first write, the universe may come with any rate
+        for action in actions[:len(self.action_steps)]:
+            motor, rate = ACTION_RATES[action]
+            if rates[motor] == rate:
+                self.writes.append(None)
+            else:
+                rates[motor] = rate
+                self.writes.append((motor, rate))
+
+    def num_writes(self) -> int:
+        """Motor rate writes left after removing the redundant ones"""
+        return sum(write is not None for write in self.writes)
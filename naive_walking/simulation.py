@@ -1,7 +1,16 @@
-import pyglet
-from pymunk.pyglet_util import DrawOptions
 from universe import Universe, Figure
+from trajectory import Trajectory, TrajectoryRecorder
+from metrics import Metrics
+from schedule import ActionSchedule
 from typing import List
+import time
+
+
+def _lower_bound(universe: Universe, flipped_reach: float = None) -> float:
+    bound = universe.score
+    if flipped_reach is not None and universe.is_flipped():
+        bound += max(0.0, universe.distance() - flipped_reach)
+    return bound
 
 
 class Simulation:
@@ -16,114 +25,132 @@ class Simulation:
             self, actions: List[int],
             figure: Figure,
             runtime: float = 10,  # in seconds
-            fps: float = 1.0 / 30  # 30 frames per second
+            fps: float = 1.0 / 30,  # 30 frames per second
+            universe: Universe = None  # e.g. from a UniversePool, used instead of a new universe for the figure
     ):
 
         self.actions = actions
         self.num_actions_per_second = runtime / len(actions)
-        self.universe = Universe(figure)
         self.runtime = runtime
         self.fps = fps
         self.score: float = None
-
-    def run(self) -> None:
-        current_time = 0.0
-        current_action = 1
-        runtime_reached = False
-
-        while not runtime_reached:
-            self.universe.space.step(self.fps)
-            current_time += self.fps
-
-            if current_action < (current_time / self.num_actions_per_second):
-                movement = self.actions[current_action - 1]
-                if movement == 0:
-                    self.universe.move_left_poly('up')
-                if movement == 1:
-                    self.universe.move_left_poly('down')
-                if movement == 2:
-                    self.universe.move_right_poly('up')
-                if movement == 3:
-                    self.universe.move_right_poly('down')
-                current_action = current_action + 1
+        self.current_time = 0.0
+        self.current_action = 1
+        self.steps = 0  # number of physics steps done so far
+        self.pruned = False  # True if run() stopped early, score is then a lower bound
+        self.trajectory: Trajectory = None  # set by run(record=True)
+        self.schedule = ActionSchedule(actions, runtime, fps)
+        self._overlap_floors: List[float] = None  # lowest overlap still to come before every action, see lower_bound
+        self.universe = universe if universe is not None else Universe(figure)
+
+    def run(
+            self,
+            threshold: float = None,
+            flipped_reach: float = None,
+            record: bool = False,
+            metrics: Metrics = None
+    ) -> None:
+        """Runs the simulation until the runtime is reached
+
+        With a threshold the simulation stops early as soon as its score can
+        no longer end up below it (see lower_bound), it is then marked as
+        pruned and its score is the lower bound.
+        With record the pose of the figure and the obstacle is stored after
+        every step in self.trajectory, which Display can play back.
+        With metrics the time spent stepping, applying actions and computing
+        the overlap is added to it (phases step, actions and overlap).
+        """
+        recorder = None
+        if record:
+            recorder = TrajectoryRecorder(self.remaining_steps() + 1, len(self.universe.get_pose()), self.fps)
+            recorder.record(self.universe)
+
+        clock = time.perf_counter
+        schedule = self.schedule
+        actions_at, writes, times = schedule.actions_at, schedule.writes, schedule.times
+        motors = self.universe.motors
+        step = self.universe.space.step
+
+        while self.steps < schedule.num_steps:
+            if metrics is not None:
+                start = clock()
+            step(self.fps)
+            self.steps += 1
+            self.current_time = times[self.steps]
+            if metrics is not None:
+                metrics.add('step', clock() - start)
+
+            index = actions_at[self.steps]
+            if index is not None:
+                if metrics is not None:
+                    start = clock()
+                write = writes[index]
+                if write is not None:
+                    motors[write[0]].rate = write[1]
+                self.current_action = index + 2
+                if metrics is not None:
+                    now = clock()
+                    metrics.add('actions', now - start)
+                    start = now
 
                 # calculate overlap between figure and obstacle every step
                 self.universe.calculate_overlap()
-
-            if current_time > self.runtime:
-                runtime_reached = True
+                if metrics is not None:
+                    metrics.add('overlap', clock() - start)
+
+                if threshold is not None:
+                    bound = self.lower_bound(flipped_reach)
+                    if bound > threshold:
+                        self.pruned = True
+                        self.score = bound
+                        if recorder is not None:
+                            recorder.record(self.universe)
+                            self.trajectory = recorder.trajectory(self.score)
+                        return
+
+            if recorder is not None:
+                recorder.record(self.universe)
 
         # calculate the distance reached at the end of the simulation
         self.universe.calculate_distance()
         self.score = self.universe.score
+        if recorder is not None:
+            self.trajectory = recorder.trajectory(self.score)
+
+    def lower_bound(self, flipped_reach: float = None) -> float:
+        """Lowest score the simulation can still end with
+
+        The distance to the finish is never negative, and an overlap is
+        negative only while the obstacle passes the left wall, by at most
+        Universe.overlap_floor. So the score so far plus the floors of the
+        overlaps still to come is a bound. With flipped_reach a figure lying
+        upside down is assumed to end at most flipped_reach closer to the
+        finish than it is now.
+        """
+        if self._overlap_floors is None:
+            # the obstacle ignores the figure, its future is known from its current state
+            action_steps, times = self.schedule.action_steps, self.schedule.times
+            floors = [0.0] * (len(action_steps) + 1)
+            for index in reversed(range(len(action_steps))):
+                floor = 0.0
+                if action_steps[index] > self.steps:
+                    floor = self.universe.overlap_floor(times[action_steps[index]] - times[self.steps])
+                floors[index] = floors[index + 1] + floor
+            self._overlap_floors = floors
+        # the next action to fire has the index current_action - 1
+        return _lower_bound(self.universe, flipped_reach) + self._overlap_floors[self.current_action - 1]
+
+    def remaining_steps(self) -> int:
+        """Number of physics steps left until the runtime is reached"""
+        return self.schedule.num_steps - self.steps
 
     def evaluate(self) -> float:
         return self.score
 
 
-class Display(pyglet.window.Window):
-    """ Given a list of actions displays the simulation using Pyglet
-    Similar code as in Simulation class.
-    """
-    def __init__(
-            self,
-            actions: List[int],
-            figure: Figure,
-            label: str = '',
-            runtime: float = 10
-    ):
-
-        super().__init__(width=1000, height=400, caption='Walking evolution ', resizable=False)
-        self.actions = actions
-        self.num_actions_per_second = runtime / len(actions)
-        self.universe = Universe(figure)
-        self.current_action = 1
-        self.current_time = 0.0
-        self.fps = 1.0 / 30
-        self.runtime = runtime
-        self.label = pyglet.text.Label(
-            label, font_name='Arial', font_size=22,
-            x=170, y=320, anchor_x='center', anchor_y='center',
-        )
-        self.score: float = None
-
-    def on_draw(self) -> None:
-        super().clear()
-        self.universe.space.debug_draw(DrawOptions())
-        self.label.draw()
-
-    def update(self, dt) -> None:
-        self.universe.space.step(self.fps)
-        self.current_time = self.current_time + self.fps
-
-        if self.current_action < (self.current_time / self.num_actions_per_second):
-            movement = self.actions[self.current_action - 1]
-            if movement == 0:
-                self.universe.move_left_poly('up')
-            if movement == 1:
-                self.universe.move_left_poly('down')
-            if movement == 2:
-                self.universe.move_right_poly('up')
-            if movement == 3:
-                self.universe.move_right_poly('down')
-            self.current_action = self.current_action + 1
-
-            # calculate overlap between figure and obstacle every step
-            self.universe.calculate_overlap()
-
-        # calculate distance between figure and right wall in the end of the simulation
-        if self.current_time > self.runtime:
-            self.universe.calculate_distance()
-            self.score = self.universe.score
-            self.close()
-
-    def close(self) -> None:
-        super().close()
-        pyglet.app.exit()
-
-    def display_simulation(self) -> None:
-        pyglet.clock.schedule_interval(self.update, self.fps)
-        pyglet.app.run()
-
-    def get_score(self) -> float:
-        return self.score
+def __getattr__(name: str):
+    # the viewer needs pyglet and a display, it is only imported when asked for
+    if name == 'Display':
+        from display import Display
+        return Display
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
@@ -0,0 +1,23 @@
+class EvaluationStats:
+    """Counts the work done by an evaluator since the last reset()"""
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.simulations = 0  # simulations run, including pruned ones
+        self.steps = 0  # physics steps done
+        self.pruned = 0  # simulations stopped early
+        self.steps_skipped = 0  # physics steps not done because of early stopping
+        self.seconds = 0.0  # wall time spent evaluating
+
+    def add(self, steps: int, pruned: bool, steps_skipped: int) -> None:
+        self.simulations += 1
+        self.steps += steps
+        self.pruned += int(pruned)
+        self.steps_skipped += steps_skipped
+
+    def seconds_saved(self) -> float:
+        """Estimated time saved by early stopping, at the measured cost of a physics step"""
+        if self.steps == 0:
+            return 0.0
+        return self.seconds / self.steps * self.steps_skipped
@@ -0,0 +1,119 @@
+from evaluation import spearman
+from typing import List, Sequence
+import math
+import numpy as np
+
+NUM_MOVES = 4  # actions 0 to 3
+
+
+def one_hot(population_actions: Sequence[Sequence[int]]) -> np.ndarray:
+    """Features of action lists: one column per (position, action) and a constant column"""
+    actions = np.asarray(population_actions, dtype=np.int64)
+    size, length = actions.shape
+    features = np.zeros((size, length * NUM_MOVES + 1))
+    features[np.arange(size)[:, None], np.arange(length) * NUM_MOVES + actions] = 1.0
+    features[:, -1] = 1.0
+    return features
+
+
+class RidgeRegression:
+    """Ridge regression trained online from sufficient statistics
+
+    Every update first multiplies the statistics gathered so far by
+    forgetting, so old generations weigh less as the population moves on.
+    """
+    def __init__(self, num_features: int, alpha: float = 1.0, forgetting: float = 0.9):
+        self.alpha = alpha
+        self.forgetting = forgetting
+        self._gram = np.zeros((num_features, num_features))
+        self._moment = np.zeros(num_features)
+        self._weights = np.zeros(num_features)
+        self.samples = 0.0  # effective number of samples after forgetting
+
+    def update(self, features: np.ndarray, targets: np.ndarray) -> None:
+        self._gram = self.forgetting * self._gram + features.T @ features
+        self._moment = self.forgetting * self._moment + features.T @ targets
+        self.samples = self.forgetting * self.samples + len(targets)
+        regularization = self.alpha * np.eye(len(self._moment))
+        self._weights = np.linalg.solve(self._gram + regularization, self._moment)
+
+    def predict(self, features: np.ndarray) -> np.ndarray:
+        return features @ self._weights
+
+
+class Surrogate:
+    """Pre-screens crossover offspring with a model of the score, see GeneticAlgorithm(surrogate=...)
+
+    A ridge regression on one-hot genomes is trained online on every
+    simulated (genome, score) pair. Once it has seen min_samples, only the
+    best fraction of each generation's crossover offspring by predicted
+    score is simulated; the others get an infinite score like the
+    individuals rejected by screening. After every generation the predicted
+    and the simulated scores of the simulated offspring are compared.
+    """
+    def __init__(
+            self,
+            fraction: float = 0.5,  # share of the crossover offspring that is simulated
+            alpha: float = 1.0,  # ridge regularization
+            forgetting: float = 0.9,  # weight of the previous generations at every update
+            min_samples: int = 200  # simulated individuals seen before the model screens anything
+    ):
+
+        self.fraction = fraction
+        self.alpha = alpha
+        self.forgetting = forgetting
+        self.min_samples = min_samples
+        self.model: RidgeRegression = None
+        self.skipped = 0  # offspring not simulated in the last generation
+        self.simulations_saved = 0  # offspring not simulated in the whole run
+        self.rank_agreement = float('nan')  # Spearman correlation of predicted and simulated scores
+        self.mean_absolute_error = float('nan')
+        self._predictions: np.ndarray = None
+        self._selected: List[int] = []
+
+    @property
+    def trained(self) -> bool:
+        return self.model is not None and self.model.samples >= self.min_samples
+
+    def select(self, population_actions: Sequence[Sequence[int]]) -> List[int]:
+        """Indices of the action lists worth simulating, all of them while the model is untrained"""
+        self.skipped = 0
+        self._predictions = None
+        if not self.trained or len(population_actions) == 0:
+            self._selected = list(range(len(population_actions)))
+            return self._selected
+        predictions = self.model.predict(one_hot(population_actions))
+        num_selected = max(1, int(math.ceil(len(population_actions) * self.fraction)))
+        self._selected = sorted(int(index) for index in np.argsort(predictions, kind='stable')[:num_selected])
+        self._predictions = predictions
+        self.skipped = len(population_actions) - num_selected
+        self.simulations_saved += self.skipped
+        return self._selected
+
+    def update(self, population_actions: Sequence[Sequence[int]], scores: Sequence[float]) -> None:
+        """Trains the model on completed simulations, infinite scores are ignored
+
+        Scores of pruned simulations are lower bounds and must be left out.
+        """
+        scores = np.asarray(scores, dtype=np.float64)
+        finite = np.isfinite(scores)
+        if not finite.any():
+            return
+        features = one_hot([actions for actions, keep in zip(population_actions, finite) if keep])
+        if self.model is None:
+            self.model = RidgeRegression(features.shape[1], self.alpha, self.forgetting)
+        self.model.update(features, scores[finite])
+
+    def measure(self, scores: Sequence[float]) -> None:
+        """Compares the predictions of the last select() with the simulated scores
+
+        scores belong to the action lists passed to select(), the ones that
+        were not simulated (or are only a bound) are infinite.
+        """
+        if self._predictions is None:
+            return
+        predicted = self._predictions[self._selected]
+        actual = np.asarray(scores, dtype=np.float64)[self._selected]
+        finite = np.isfinite(actual)
+        self.rank_agreement = spearman(predicted[finite], actual[finite])
+        self.mean_absolute_error = float(np.abs(predicted[finite] - actual[finite]).mean()) if finite.any() else math.nan
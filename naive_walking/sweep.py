@@ -0,0 +1,229 @@
+from universe import Figure
+from ga import GeneticAlgorithm
+from typing import Dict, List
+import argparse
+import contextlib
+import csv
+import hashlib
+import inspect
+import itertools
+import json
+import math
+import multiprocessing
+import multiprocessing.connection
+import os
+import random
+import time
+import traceback
+
+# arguments of GeneticAlgorithm a sweep can set, everything but the figure and objects like metrics
+SETTINGS = tuple(name for name in inspect.signature(GeneticAlgorithm.__init__).parameters
+                 if name not in ('self', 'figure', 'metrics', 'migration', 'screening', 'surrogate'))
+PATHS = ('results_path', 'checkpoint_path', 'cache_path')  # relative to the directory of every run
+COLUMNS = ('best_score', 'wall_seconds', 'evaluations', 'evaluations_per_second')
+
+
+def grid(space: Dict[str, List]) -> List[Dict]:
+    """Every combination of the values listed for each setting"""
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def sample(space: Dict, num_samples: int, seed: int = None) -> List[Dict]:
+    """num_samples random points of a search space
+
+    A list is sampled uniformly, a range {"low": 0.05, "high": 0.3} from a
+    uniform distribution, with "log": true from a log-uniform one and with
+    "integer": true rounded to an integer.
+    """
+    generator = random.Random(seed)
+    points = []
+    for _ in range(num_samples):
+        point = {}
+        for name in sorted(space):
+            values = space[name]
+            if isinstance(values, list):
+                point[name] = generator.choice(values)
+                continue
+            low, high = values['low'], values['high']
+            if values.get('log', False):
+                value = math.exp(generator.uniform(math.log(low), math.log(high)))
+            else:
+                value = generator.uniform(low, high)
+            point[name] = int(round(value)) if values.get('integer', False) else value
+        points.append(point)
+    return points
+
+
+def configurations(config: Dict) -> List[Dict]:
+    """The GA settings of every run of a sweep config, fixed settings included"""
+    search = config.get('search', 'grid')
+    space = config.get('space', {})
+    if search == 'grid':
+        points = grid(space)
+    elif search == 'random':
+        points = sample(space, config['num_samples'], config.get('seed'))
+    else:
+        raise ValueError('Unknown search {}, use grid or random'.format(search))
+    runs = {}  # a random search can draw a point twice, it is run once
+    for point in points:
+        settings = dict(config.get('fixed', {}), **point)
+        unknown = set(settings) - set(SETTINGS)
+        if unknown:
+            raise ValueError('Unknown GA settings {}, use some of {}'.format(sorted(unknown), SETTINGS))
+        runs.setdefault(run_id(settings), settings)
+    return list(runs.values())
+
+
+def run_id(settings: Dict) -> str:
+    """Name of the directory of a run, the same settings always get the same name"""
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def cpus_needed(settings: Dict, cpus: int) -> int:
+    """Processes a run keeps busy: its workers, all CPUs of the budget for num_workers=None"""
+    num_workers = settings.get('num_workers', 1)
+    return cpus if num_workers is None else max(1, num_workers)
+
+
+def _write_json(path: str, data: Dict) -> None:
+    # written to a temporary file and moved into place, a crash never leaves half a file
+    with open(path + '.tmp', 'w') as file:
+        json.dump(data, file)
+    os.replace(path + '.tmp', path)
+
+
+def _run_process(settings: Dict, run_path: str) -> None:
+    """Runs one configuration, its output goes to run.log and the result to result.json"""
+    seed = settings.get('seed')
+    random.seed(seed)
+    settings = dict(settings)
+    for name in PATHS:
+        if settings.get(name) is not None:
+            settings[name] = os.path.join(run_path, settings[name])
+    try:
+        with open(os.path.join(run_path, 'run.log'), 'w') as log, contextlib.redirect_stdout(log):
+            start = time.perf_counter()
+            ga = GeneticAlgorithm(figure=Figure(), **settings)
+            ga.run()
+            wall_seconds = time.perf_counter() - start
+        _write_json(os.path.join(run_path, 'result.json'), {
+            'settings': settings,
+            'best_score': float(ga.best_individual.score),
+            'best_actions': [int(action) for action in ga.best_individual.actions],
+            'wall_seconds': wall_seconds,
+            'evaluations': ga.simulations,
+            'evaluations_per_second': ga.simulations / wall_seconds if wall_seconds > 0 else 0.0,
+        })
+    except BaseException:
+        with open(os.path.join(run_path, 'error.txt'), 'w') as file:
+            file.write(traceback.format_exc())
+        raise
+
+
+class Sweep:
+    """Runs every configuration of a sweep config on processes, within a CPU budget
+
+    Every run gets a directory in output_path named after its settings, with
+    its log and, once finished, result.json. Runs that already have one are
+    skipped, so an interrupted sweep continues where it stopped and a grown
+    search space only runs the new points. A run occupies as many CPUs of
+    the budget as it has workers; runs start in config order as soon as
+    enough CPUs are free. After every finished run results.csv is written,
+    one row per finished configuration sorted by best score.
+    """
+    def __init__(self, config: Dict, output_path: str = None, cpus: int = None):
+        self.runs = configurations(config)
+        self.output_path = output_path or config.get('output', 'sweep')
+        self.cpus = cpus or config.get('cpus') or multiprocessing.cpu_count()
+        self.finished = 0
+        self.failed: List[str] = []
+        for settings in self.runs:
+            if cpus_needed(settings, self.cpus) > self.cpus:
+                raise ValueError('A run with {} workers does not fit a budget of {} CPUs'.format(
+                    settings['num_workers'], self.cpus))
+
+    def run_path(self, settings: Dict) -> str:
+        return os.path.join(self.output_path, 'runs', run_id(settings))
+
+    def is_finished(self, settings: Dict) -> bool:
+        return os.path.exists(os.path.join(self.run_path(settings), 'result.json'))
+
+    def run(self) -> None:
+        pending = [settings for settings in self.runs if not self.is_finished(settings)]
+        print('{} configurations, {} finished already, {} CPUs'.format(
+            len(self.runs), len(self.runs) - len(pending), self.cpus))
+        running = {}  # process sentinel -> (process, settings)
+        free = self.cpus
+        while pending or running:
+            # start what fits, a big run does not hold back smaller ones behind it
+            for settings in list(pending):
+                needed = cpus_needed(settings, self.cpus)
+                if needed <= free:
+                    os.makedirs(self.run_path(settings), exist_ok=True)
+                    process = multiprocessing.Process(target=_run_process, args=(settings, self.run_path(settings)))
+                    process.start()
+                    running[process.sentinel] = process, settings
+                    pending.remove(settings)
+                    free -= needed
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                process, settings = running.pop(sentinel)
+                process.join()
+                free += cpus_needed(settings, self.cpus)
+                self._finish(settings, process.exitcode)
+        self.write_table()
+        print('{} runs finished, {} failed, results in {}'.format(
+            self.finished, len(self.failed), os.path.join(self.output_path, 'results.csv')))
+
+    def _finish(self, settings: Dict, exitcode: int) -> None:
+        name = run_id(settings)
+        if not self.is_finished(settings):
+            self.failed.append(name)
+            print('Run {} failed with exit code {}, see {}'.format(name, exitcode, self.run_path(settings)))
+            return
+        self.finished += 1
+        with open(os.path.join(self.run_path(settings), 'result.json')) as file:
+            result = json.load(file)
+        print('Run {} finished: best score {}, {:.1f}s, {:.0f} evaluations/s'.format(
+            name, int(result['best_score']), result['wall_seconds'], result['evaluations_per_second']))
+        self.write_table()
+
+    def results(self) -> List[Dict]:
+        """One row per finished configuration: run, settings and COLUMNS, best score first"""
+        rows = []
+        for settings in self.runs:
+            if not self.is_finished(settings):
+                continue
+            with open(os.path.join(self.run_path(settings), 'result.json')) as file:
+                result = json.load(file)
+            row = {'run': run_id(settings)}
+            row.update(settings)
+            row.update((column, result[column]) for column in COLUMNS)
+            rows.append(row)
+        rows.sort(key=lambda row: row['best_score'])
+        return rows
+
+    def write_table(self) -> None:
+        rows = self.results()
+        names = sorted({name for settings in self.runs for name in settings})
+        path = os.path.join(self.output_path, 'results.csv')
+        os.makedirs(self.output_path, exist_ok=True)
+        with open(path + '.tmp', 'w', newline='') as file:
+            writer = csv.DictWriter(file, ['run'] + names + list(COLUMNS))
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(path + '.tmp', path)
+
+
+# the guard keeps run processes from starting the sweep again when they import this module
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a grid or random search over GA settings, non-interactive')
+    parser.add_argument('config', help='JSON file with search, space, fixed and optionally num_samples, seed, '
+                                       'cpus and output, see README')
+    parser.add_argument('--cpus', type=int, help='CPU budget, overrides the config (default all CPUs)')
+    parser.add_argument('--output', help='directory of the runs and results.csv, overrides the config')
+    args = parser.parse_args()
+
+    with open(args.config) as config_file:
+        sweep_config = json.load(config_file)
+    Sweep(sweep_config, args.output, args.cpus).run()
@@ -0,0 +1,62 @@
+from typing import Optional
+import json
+import numpy as np
+
+
+class Trajectory:
+    """Poses of the bodies of a universe, one frame per physics step
+
+    frames has the shape (num_frames, num_bodies, 3), every row holds x, y and
+    angle of a body (see Universe.get_pose). Frame 0 is the pose before the
+    first step. Saved as a .npy file, which np.load can memory-map, and a small
+    .json file next to it with fps and score.
+    """
+    def __init__(self, frames: np.ndarray, fps: float = 1.0 / 30, score: float = None):
+        self.frames = frames
+        self.fps = fps
+        self.score = score
+
+    @property
+    def duration(self) -> float:
+        """Simulated time covered by the frames in seconds"""
+        return (len(self.frames) - 1) * self.fps
+
+    def save(self, path: str) -> None:
+        np.save(path, self.frames)
+        with open(_metadata_path(path), 'w') as metadata:
+            json.dump({'fps': self.fps, 'score': self.score}, metadata)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'Trajectory':
+        """Loads a saved trajectory, by default the frames are memory-mapped"""
+        frames = np.load(path, mmap_mode='r' if mmap else None)
+        with open(_metadata_path(path)) as metadata:
+            info = json.load(metadata)
+        return cls(frames, info['fps'], info['score'])
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+
+def _metadata_path(path: str) -> str:
+    if path.endswith('.npy'):
+        path = path[:-len('.npy')]
+    return path + '.json'
+
+
+class TrajectoryRecorder:
+    """Writes the pose of a universe into a preallocated array after every step"""
+    def __init__(self, num_frames: int, num_bodies: int, fps: float = 1.0 / 30):
+        self.fps = fps
+        self._frames = np.empty((num_frames, num_bodies, 3), dtype=np.float32)
+        self._length = 0
+
+    def record(self, universe) -> None:
+        if self._length == len(self._frames):
+            # runtime not a multiple of fps, room for a few more frames
+            self._frames = np.concatenate([self._frames, np.empty_like(self._frames[:16])])
+        self._frames[self._length] = universe.get_pose()
+        self._length += 1
+
+    def trajectory(self, score: Optional[float] = None) -> Trajectory:
+        return Trajectory(self._frames[:self._length].copy(), self.fps, score)
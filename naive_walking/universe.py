@@ -1,6 +1,12 @@
 import pymunk
 from pymunk import Vec2d
-from typing import Tuple
+from typing import List, Tuple
+import copy
+import math
+
+# no polygon of the figure gets further left: the left wall is at x=60 and contacts let a polygon sink into it by
+# about a pixel (59.1 was the lowest left edge in 150 random runs), the rest is margin
+FIGURE_MIN_X = 50.0
 
 
 class Polygon:
@@ -65,6 +71,21 @@ class Joint:
         self._joint = joint
         self._motor = motor
 
+    def renew(self) -> None:
+        """Replaces the pivot joint and the motor by new ones with the same settings
+
+        New constraints start without the impulses Chipmunk accumulates in
+        them while stepping, like the constraints of a new figure.
+        """
+        old_joint, old_motor = self._joint, self._motor
+        self._joint = pymunk.PivotJoint(old_joint.a, old_joint.b, old_joint.anchor_a, old_joint.anchor_b)
+        self._motor = pymunk.SimpleMotor(old_motor.a, old_motor.b, old_motor.rate)
+        for old, new in ((old_joint, self._joint), (old_motor, self._motor)):
+            new.max_force = old.max_force
+            new.max_bias = old.max_bias
+            new.error_bias = old.error_bias
+            new.collide_bodies = old.collide_bodies
+
     @property
     def motor(self) -> pymunk.SimpleMotor:
         return self._motor
@@ -189,7 +210,12 @@ class Figure:
 
 
 class Universe:
-    def __init__(self, figure: Figure):
+    def __init__(
+            self,
+            figure: Figure,
+            iterations: int = 10  # solver iterations per step, fewer is faster and less accurate
+    ):
+        self.iterations = iterations
         self._space = pymunk.Space()
         self._add_walls()
         self._add_obstacle()
@@ -198,6 +224,8 @@ class Universe:
         self.add_figure(figure)
         self._finish_position = 940
         self._space.gravity = (0, -100)
+        self._space.iterations = iterations
+        self._initial_state = self.get_state()
 
     def _add_walls(self) -> None:
         static_lines = [
@@ -224,20 +252,50 @@ class Universe:
         self._obstacle_shape = circle_shape
 
     def add_figure(self, figure: Figure) -> None:
+        self._figure = figure
+        self._space.add(*self._figure_items())
+
+    def _figure_items(self) -> List:
+        figure = self._figure
         center_poly = figure.center_poly
         right_poly = figure.right_poly
         left_poly = figure.left_poly
         left_joint = figure.left_joint
         right_joint = figure.right_joint
-
-        self._figure = figure
-        self._space.add(
+        return [
             center_poly.body, center_poly.shape,
             left_poly.body, left_poly.shape,
             right_poly.body, right_poly.shape,
             left_joint.joint, left_joint.motor,
             right_joint.joint, right_joint.motor
-        )
+        ]
+
+    def reset(self) -> None:
+        """Brings the universe back to the state it was created in
+
+        The bodies and shapes of the figure and the obstacle are reused, only
+        the space, the walls and the constraints are created again: Chipmunk
+        keeps contact and joint impulses and collision pair ids in them.
+        The bias velocities left in the bodies by the solver are cleared.
+        Objects are added in the same order as in __init__, so a simulation
+        after reset() is bit-for-bit the simulation in a new universe.
+        """
+        self._space.remove(self._obstacle, self._obstacle_shape, *self._figure_items())
+        self._figure.left_joint.renew()
+        self._figure.right_joint.renew()
+        for body in self._bodies():
+            # a position update with dt=0 clears the bias velocities the solver left in the body
+            pymunk.Body.update_position(body, 0)
+            body.force = (0, 0)
+            body.torque = 0
+        self.set_state(self._initial_state)
+
+        self._space = pymunk.Space()
+        self._add_walls()
+        self._space.add(self._obstacle, self._obstacle_shape)
+        self._space.add(*self._figure_items())
+        self._space.gravity = (0, -100)
+        self._space.iterations = self.iterations
 
     def move_left_poly(self, direction) -> None:
         """Moves left polygon up/down"""
@@ -247,12 +305,90 @@ class Universe:
         """Moves right polygon up/down"""
         self._figure.move_right_poly(direction)
 
+    @property
+    def motors(self) -> Tuple[pymunk.SimpleMotor, pymunk.SimpleMotor]:
+        """Left and right motor, replaced by reset()"""
+        return self._figure.left_joint.motor, self._figure.right_joint.motor
+
+    def _bodies(self) -> Tuple[pymunk.Body, ...]:
+        # bodies whose state changes during a simulation
+        figure = self._figure
+        return figure.center_poly.body, figure.left_poly.body, figure.right_poly.body, self._obstacle
+
+    def get_state(self) -> Tuple:
+        """Returns the position, angle and velocities of every body, the motor rates and the score"""
+        bodies = tuple(
+            (tuple(body.position), body.angle, tuple(body.velocity), body.angular_velocity)
+            for body in self._bodies()
+        )
+        rates = (self._figure.left_joint.motor.rate, self._figure.right_joint.motor.rate)
+        return bodies, rates, self._score
+
+    def set_state(self, state: Tuple) -> None:
+        """Restores a state returned by get_state
+
+        Only the bodies, motors and score are restored. Chipmunk keeps the
+        contact and joint impulses of the previous steps and the order of
+        its collision pairs internally, pymunk does not expose them. The
+        continuation is therefore not bit-for-bit the run the state was
+        taken from and, the walker being chaotic, can end elsewhere.
+        """
+        bodies, rates, score = state
+        for body, (position, angle, velocity, angular_velocity) in zip(self._bodies(), bodies):
+            body.position = position
+            body.angle = angle
+            body.velocity = velocity
+            body.angular_velocity = angular_velocity
+            if body.space is not None:
+                self._space.reindex_shapes_for_body(body)
+        self._figure.left_joint.motor.rate, self._figure.right_joint.motor.rate = rates
+        self._score = score
+
+    def get_pose(self) -> List[Tuple[float, float, float]]:
+        """Returns x, y and angle of every moving body, see trajectory.Trajectory"""
+        pose = []
+        for body in self._bodies():
+            position = body.position  # a single conversion from chipmunk per body
+            pose.append((position.x, position.y, body.angle))
+        return pose
+
+    def set_pose(self, pose) -> None:
+        """Places the bodies at a pose returned by get_pose, for drawing only"""
+        for body, (x, y, angle) in zip(self._bodies(), pose):
+            body.position = float(x), float(y)
+            body.angle = float(angle)
+            if body.space is not None:
+                self._space.reindex_shapes_for_body(body)
+
+    def distance(self) -> float:
+        """Distance between the figure (center polygon) and the finish at the current time step"""
+        figure_position_x = self._figure.center_poly.centroid[0]
+        return self._finish_position - figure_position_x
+
     def calculate_distance(self) -> float:
         """Calculates the distance between the ball and
         the figure (center polygon) at the current time step"""
-        figure_position_x = self._figure.center_poly.centroid[0]
-        distance = self._finish_position - figure_position_x
-        self._score += distance
+        self._score += self.distance()
+
+    def is_flipped(self) -> bool:
+        """True if the center polygon is upside down"""
+        angle = math.remainder(self._figure.center_poly.body.angle, 2 * math.pi)
+        return abs(angle) > math.pi / 2
+
+    def overlap_floor(self, seconds: float) -> float:
+        """Lowest overlap calculate_overlap can add seconds from now
+
+        A polygon touching the obstacle adds max(left) - min(top) of the two
+        bounding boxes, at least max(FIGURE_MIN_X, obstacle left) - obstacle
+        top, which is negative once the obstacle has moved far enough left.
+        The obstacle moves at a constant velocity, so its box is known in
+        advance; once it is left of FIGURE_MIN_X it touches nothing.
+        """
+        x, y = self._obstacle.position + self._obstacle.velocity * seconds
+        radius = self._obstacle_shape.radius
+        if x + radius < FIGURE_MIN_X:
+            return 0.0
+        return 3 * min(0.0, max(FIGURE_MIN_X, x - radius) - (y + radius))
 
     def calculate_overlap(self) -> None:
         """ Calculates overlap at the current time step """
@@ -284,3 +420,30 @@ class Universe:
     @property
     def score(self) -> Figure:
         return self._score
+
+
+class UniversePool:
+    """Hands out universes with a copy of the template figure in its initial state
+
+    A released universe is reset and handed out again, so the figure is
+    copied and the universe built only once per pooled universe instead of
+    once per simulation.
+    """
+    def __init__(self, figure: Figure, iterations: int = 10):
+        self._template = figure
+        self.iterations = iterations  # solver iterations of the universes, see Universe
+        self._free: List[Universe] = []
+        self.created = 0  # universes built
+        self.reused = 0  # universes reset and handed out again
+
+    def acquire(self) -> Universe:
+        if self._free:
+            universe = self._free.pop()
+            universe.reset()
+            self.reused += 1
+            return universe
+        self.created += 1
+        return Universe(copy.deepcopy(self._template), iterations=self.iterations)
+
+    def release(self, universe: Universe) -> None:
+        self._free.append(universe)
@@ -0,0 +1,463 @@
+from universe import Figure, Universe
+from simulation import Simulation
+from trajectory import Trajectory
+from schedule import ACTION_RATES, ActionSchedule
+from typing import List, Sequence
+import copy
+import numpy as np
+
+# bodies of one individual: the three polygons of the figure and the static walls
+CENTER, LEFT, RIGHT, STATIC = 0, 1, 2, 3
+NUM_BODIES = 4
+
+# walls of the universe as half planes: inward normal and offset (segment position plus its radius of 2)
+_WALL_NORMALS = np.array([(0.0, 1.0), (1.0, 0.0), (-1.0, 0.0), (0.0, -1.0)])
+_WALL_OFFSETS = np.array([52.0, 62.0, -938.0, -298.0])
+
+# polygon pairs that collide, both ways: the vertices of the first against the edges of the second
+_POLYGON_PAIRS = [(CENTER, LEFT), (LEFT, CENTER), (CENTER, RIGHT), (RIGHT, CENTER), (LEFT, RIGHT), (RIGHT, LEFT)]
+
+
+class WalkerModel:
+    """Geometry and mass properties of the figure, read once from its pymunk objects"""
+    def __init__(self, figure: Figure):
+        polygons = (figure.center_poly, figure.left_poly, figure.right_poly)
+        self.vertices = np.array([[tuple(vertex) for vertex in polygon.shape.get_vertices()] for polygon in polygons])
+        edges = np.roll(self.vertices, -1, axis=1) - self.vertices
+        normals = np.stack((edges[..., 1], -edges[..., 0]), axis=-1)  # outward for counter-clockwise vertices
+        self.normals = normals / np.linalg.norm(normals, axis=-1, keepdims=True)
+        self.position = np.array([tuple(polygon.body.position) for polygon in polygons])
+        self.angle = np.array([polygon.body.angle for polygon in polygons])
+        mass = np.array([polygon.body.mass for polygon in polygons])
+        moment = np.array([polygon.body.moment for polygon in polygons])
+        self.mass_inverse = np.append(1.0 / mass, 0.0)
+        self.moment_inverse = np.append(1.0 / moment, 0.0)
+        joints = (figure.left_joint, figure.right_joint)
+        self.anchors = np.array([[tuple(joint.joint.anchor_a), tuple(joint.joint.anchor_b)] for joint in joints])
+        self.max_torque = np.array([joint.motor.max_force for joint in joints])
+        self.error_bias = figure.left_joint.joint.error_bias
+
+
+class VectorUniverse:
+    """Universes of a whole population stepped at once with NumPy
+
+    A sequential impulse solver specialised for the walker, following the
+    steps of Chipmunk: integrate positions, find contacts, pre-step,
+    integrate velocities, apply the cached impulses, then iterate. The pivot
+    joints and motors are solved one after another like in Chipmunk, the
+    contacts of all individuals at once (Jacobi iterations with mass
+    splitting). Contacts are found between polygon vertices and the walls
+    and between the vertices of one polygon and the edges of another;
+    every friction in the universe is 0, so contacts only push along their
+    normal. The obstacle never collides with the figure and only moves.
+    Scores follow Universe.calculate_overlap and Universe.calculate_distance.
+
+    The state is stored per body and component, e.g. velocity_x[body] holds
+    the x velocity of that body in every universe.
+
+    Experimental and not used by GeneticAlgorithm: trajectories leave
+    pymunk's after a few dozen steps, the scores barely correlate with
+    pymunk's (see validate()) and it is not faster than pymunk for
+    populations of a few hundred either.
+    """
+    gravity = (0.0, -100.0)
+    collision_slop = 0.1
+    collision_bias = (1 - 0.1) ** 60
+    finish_position = 940
+
+    def __init__(self, figure: Figure, size: int, iterations: int = 10):
+        self.model = WalkerModel(figure)
+        self.size = size
+        self.iterations = iterations
+        model = self.model
+        shape = (NUM_BODIES, size)
+        self.x = np.zeros(shape)
+        self.y = np.zeros(shape)
+        self.angle = np.zeros(shape)
+        self.x[:3] = model.position[:, 0, None]
+        self.y[:3] = model.position[:, 1, None]
+        self.angle[:3] = model.angle[:, None]
+        self.velocity_x = np.zeros(shape)
+        self.velocity_y = np.zeros(shape)
+        self.angular_velocity = np.zeros(shape)
+        self.bias_velocity_x = np.zeros(shape)
+        self.bias_velocity_y = np.zeros(shape)
+        self.bias_angular_velocity = np.zeros(shape)
+        self.rates = np.zeros((2, size))  # left and right motor rate
+        self.scores = np.zeros(size)
+        self.obstacle_position = np.array([930.0, 70.0])
+        self.obstacle_angle = 0.0
+        self.obstacle_velocity = np.array([-100.0, 0.0])
+        self.obstacle_angular_velocity = 0.5
+        self.obstacle_radius = 20.0
+        self._mass_inverse = np.repeat(model.mass_inverse, size)
+        self._moment_inverse = np.repeat(model.moment_inverse, size)
+        self._pivot_impulses = np.zeros((2, 2, size))  # joint, x and y
+        self._motor_impulses = np.zeros((2, size))
+        self._contact_impulses = np.zeros(self._num_slots() * size)
+        self._previous_dt = 0.0
+        self._update_vertices()
+
+    @staticmethod
+    def _num_slots() -> int:
+        return 3 * 4 * len(_WALL_OFFSETS) + len(_POLYGON_PAIRS) * 4
+
+    def _update_vertices(self) -> None:
+        """World coordinates of the polygon vertices, shape (3, 4, size)"""
+        self._cos = np.cos(self.angle[:3])
+        self._sin = np.sin(self.angle[:3])
+        cos, sin = self._cos[:, None], self._sin[:, None]
+        local_x, local_y = self.model.vertices[..., 0, None], self.model.vertices[..., 1, None]
+        self.vertices_x = self.x[:3, None] + local_x * cos - local_y * sin
+        self.vertices_y = self.y[:3, None] + local_x * sin + local_y * cos
+
+    def apply_actions(self, actions: np.ndarray, active: np.ndarray = None) -> None:
+        """Sets the motor rates of every individual for its action (0 to 3)"""
+        for action, (motor, rate) in ACTION_RATES.items():
+            selected = actions == action
+            if active is not None:
+                selected &= active
+            self.rates[motor, selected] = rate
+
+    def step(self, dt: float) -> None:
+        # integrate positions with the velocities and the bias velocities of the last step
+        self.x += (self.velocity_x + self.bias_velocity_x) * dt
+        self.y += (self.velocity_y + self.bias_velocity_y) * dt
+        self.angle += (self.angular_velocity + self.bias_angular_velocity) * dt
+        self.bias_velocity_x[:] = 0.0
+        self.bias_velocity_y[:] = 0.0
+        self.bias_angular_velocity[:] = 0.0
+        self.obstacle_position = self.obstacle_position + self.obstacle_velocity * dt
+        self.obstacle_angle += self.obstacle_angular_velocity * dt
+        self._update_vertices()
+
+        slots, body_a, body_b, normal_x, normal_y, rn1, rn2, depth = self._find_contacts()
+        pivots = self._pre_step_pivots(dt)
+        bias_coefficient = 1.0 - self.collision_bias ** dt
+
+        self.velocity_x[:3] += self.gravity[0] * dt
+        self.velocity_y[:3] += self.gravity[1] * dt
+
+        dt_coefficient = dt / self._previous_dt if self._previous_dt else 0.0
+        self._previous_dt = dt
+        impulses = self._contact_impulses[slots] * dt_coefficient
+        self._contact_impulses[:] = 0.0
+        self._pivot_impulses *= dt_coefficient
+        self._motor_impulses *= dt_coefficient
+        mass_inverse, moment_inverse = self._mass_inverse, self._moment_inverse
+
+        # normal mass of every contact, split between the contacts sharing a body
+        bodies = np.concatenate((body_a, body_b))
+        num_bodies = NUM_BODIES * self.size
+        count = np.bincount(bodies, minlength=num_bodies)
+        normal_mass = 1.0 / (count[body_a] * (mass_inverse[body_a] + moment_inverse[body_a] * rn1 ** 2) +
+                             count[body_b] * (mass_inverse[body_b] + moment_inverse[body_b] * rn2 ** 2))
+        bias = bias_coefficient * np.maximum(0.0, depth - self.collision_slop) / dt
+        bias_impulses = np.zeros_like(impulses)
+
+        # impulses along the normal act on body a with -normal and on body b with +normal
+        direction_x = np.concatenate((-normal_x, normal_x))
+        direction_y = np.concatenate((-normal_y, normal_y))
+        direction_torque = np.concatenate((-rn1, rn2))
+        velocity = (self.velocity_x.reshape(-1), self.velocity_y.reshape(-1), self.angular_velocity.reshape(-1))
+        bias_velocity = (self.bias_velocity_x.reshape(-1), self.bias_velocity_y.reshape(-1),
+                         self.bias_angular_velocity.reshape(-1))
+
+        def apply(target, delta) -> None:
+            x, y, angular = target  # views, updated in place
+            delta = np.concatenate((delta, delta))
+            x += np.bincount(bodies, direction_x * delta, num_bodies) * mass_inverse
+            y += np.bincount(bodies, direction_y * delta, num_bodies) * mass_inverse
+            angular += np.bincount(bodies, direction_torque * delta, num_bodies) * moment_inverse
+
+        def normal_velocity(target) -> np.ndarray:
+            # (v_b + w_b x r2 - v_a - w_a x r1) . n
+            x, y, angular = target
+            return ((x[body_b] - x[body_a]) * normal_x + (y[body_b] - y[body_a]) * normal_y
+                    + angular[body_b] * rn2 - angular[body_a] * rn1)
+
+        has_contacts = len(slots) > 0
+        if has_contacts:
+            apply(velocity, impulses)
+        self._apply_cached_joint_impulses(pivots)
+
+        for _ in range(self.iterations):
+            if has_contacts:
+                accumulated = np.maximum(bias_impulses + (bias - normal_velocity(bias_velocity)) * normal_mass, 0.0)
+                apply(bias_velocity, accumulated - bias_impulses)
+                bias_impulses = accumulated
+                accumulated = np.maximum(impulses - normal_velocity(velocity) * normal_mass, 0.0)
+                apply(velocity, accumulated - impulses)
+                impulses = accumulated
+            self._solve_joints(pivots, dt)
+
+        self._contact_impulses[slots] = impulses
+
+    def _find_contacts(self):
+        """Returns slots, bodies, normals (from a to b), offsets crossed with the normal and depths of all contacts"""
+        size = self.size
+        vertices_x, vertices_y = self.vertices_x, self.vertices_y  # (3, 4, size)
+        # vertices against the walls, normals point into the wall
+        wall_depth = (_WALL_OFFSETS[:, None] - vertices_x[:, :, None] * _WALL_NORMALS[:, 0, None]
+                      - vertices_y[:, :, None] * _WALL_NORMALS[:, 1, None])  # (3, 4, walls, size)
+        polygon, vertex, wall, individual = np.nonzero(wall_depth > 0.0)
+        wall_contacts = (
+            individual,
+            (polygon * 4 + vertex) * len(_WALL_OFFSETS) + wall,
+            polygon,
+            np.full(len(individual), STATIC),
+            vertices_x[polygon, vertex, individual],
+            vertices_y[polygon, vertex, individual],
+            -_WALL_NORMALS[wall, 0],
+            -_WALL_NORMALS[wall, 1],
+            wall_depth[polygon, vertex, wall, individual],
+        )
+
+        # vertices of one polygon inside another, pushed out through the closest edge
+        cos, sin = self._cos[:, None], self._sin[:, None]
+        local_x, local_y = self.model.normals[..., 0, None], self.model.normals[..., 1, None]
+        normals_x = local_x * cos - local_y * sin  # (3, 4, size)
+        normals_y = local_x * sin + local_y * cos
+        offsets = normals_x * vertices_x + normals_y * vertices_y
+        first = np.array([a for a, _ in _POLYGON_PAIRS])
+        second = np.array([b for _, b in _POLYGON_PAIRS])
+        separation = (vertices_x[first, :, None] * normals_x[second, None] +
+                      vertices_y[first, :, None] * normals_y[second, None] -
+                      offsets[second, None])  # (pairs, vertices, edges, size)
+        largest = separation.max(axis=2)
+        pair, vertex, individual = np.nonzero(largest < 0.0)
+        edge = separation[pair, vertex, :, individual].argmax(axis=1)
+        polygon_contacts = (
+            individual,
+            3 * 4 * len(_WALL_OFFSETS) + pair * 4 + vertex,
+            first[pair],
+            second[pair],
+            vertices_x[first[pair], vertex, individual],
+            vertices_y[first[pair], vertex, individual],
+            -normals_x[second[pair], edge, individual],
+            -normals_y[second[pair], edge, individual],
+            -largest[pair, vertex, individual],
+        )
+
+        individual, slot, body_a, body_b, point_x, point_y, normal_x, normal_y, depth = (
+            np.concatenate(parts) for parts in zip(wall_contacts, polygon_contacts))
+        body_a = body_a * size + individual
+        body_b = body_b * size + individual
+        x, y = self.x.reshape(-1), self.y.reshape(-1)
+        # r1 from body a to the vertex, r2 from body b to the vertex moved back onto its surface
+        rn1 = (point_x - x[body_a]) * normal_y - (point_y - y[body_a]) * normal_x
+        rn2 = (point_x - x[body_b]) * normal_y - (point_y - y[body_b]) * normal_x
+        return slot * size + individual, body_a, body_b, normal_x, normal_y, rn1, rn2, depth
+
+    def _pre_step_pivots(self, dt: float):
+        """Returns offsets, effective masses and biases of the pivot joints (see cpPivotJoint)"""
+        model = self.model
+        bias_coefficient = 1.0 - model.error_bias ** dt
+        pivots = []
+        for joint, leg in enumerate((LEFT, RIGHT)):
+            (anchor_ax, anchor_ay), (anchor_bx, anchor_by) = model.anchors[joint]
+            r1x = anchor_ax * self._cos[CENTER] - anchor_ay * self._sin[CENTER]
+            r1y = anchor_ax * self._sin[CENTER] + anchor_ay * self._cos[CENTER]
+            r2x = anchor_bx * self._cos[leg] - anchor_by * self._sin[leg]
+            r2y = anchor_bx * self._sin[leg] + anchor_by * self._cos[leg]
+            moment_a, moment_b = model.moment_inverse[CENTER], model.moment_inverse[leg]
+            k11 = k22 = model.mass_inverse[CENTER] + model.mass_inverse[leg]
+            k11 = k11 + r1y ** 2 * moment_a + r2y ** 2 * moment_b
+            k22 = k22 + r1x ** 2 * moment_a + r2x ** 2 * moment_b
+            k12 = -(r1x * r1y * moment_a + r2x * r2y * moment_b)
+            determinant = 1.0 / (k11 * k22 - k12 * k12)
+            mass = (k22 * determinant, -k12 * determinant, k11 * determinant)  # inverse of the symmetric K
+            bias_x = -((self.x[leg] + r2x) - (self.x[CENTER] + r1x)) * bias_coefficient / dt
+            bias_y = -((self.y[leg] + r2y) - (self.y[CENTER] + r1y)) * bias_coefficient / dt
+            pivots.append((leg, (r1x, r1y, r2x, r2y), mass, (bias_x, bias_y)))
+        return pivots
+
+    def _apply_cached_joint_impulses(self, pivots) -> None:
+        for joint, (leg, offsets, _, _) in enumerate(pivots):
+            self._apply_pivot_impulse(leg, offsets, self._pivot_impulses[joint, 0], self._pivot_impulses[joint, 1])
+            self._apply_motor_impulse(leg, self._motor_impulses[joint])
+
+    def _apply_pivot_impulse(self, leg: int, offsets, impulse_x: np.ndarray, impulse_y: np.ndarray) -> None:
+        model = self.model
+        r1x, r1y, r2x, r2y = offsets
+        self.velocity_x[CENTER] -= impulse_x * model.mass_inverse[CENTER]
+        self.velocity_y[CENTER] -= impulse_y * model.mass_inverse[CENTER]
+        self.angular_velocity[CENTER] -= (r1x * impulse_y - r1y * impulse_x) * model.moment_inverse[CENTER]
+        self.velocity_x[leg] += impulse_x * model.mass_inverse[leg]
+        self.velocity_y[leg] += impulse_y * model.mass_inverse[leg]
+        self.angular_velocity[leg] += (r2x * impulse_y - r2y * impulse_x) * model.moment_inverse[leg]
+
+    def _apply_motor_impulse(self, leg: int, impulse: np.ndarray) -> None:
+        # the motor acts on the leg (body a) and the center (body b)
+        self.angular_velocity[leg] -= impulse * self.model.moment_inverse[leg]
+        self.angular_velocity[CENTER] += impulse * self.model.moment_inverse[CENTER]
+
+    def _solve_joints(self, pivots, dt: float) -> None:
+        model = self.model
+        velocity_x, velocity_y, angular_velocity = self.velocity_x, self.velocity_y, self.angular_velocity
+        for joint, (leg, offsets, mass, (bias_x, bias_y)) in enumerate(pivots):
+            r1x, r1y, r2x, r2y = offsets
+            error_x = bias_x - ((velocity_x[leg] - angular_velocity[leg] * r2y) -
+                                (velocity_x[CENTER] - angular_velocity[CENTER] * r1y))
+            error_y = bias_y - ((velocity_y[leg] + angular_velocity[leg] * r2x) -
+                                (velocity_y[CENTER] + angular_velocity[CENTER] * r1x))
+            impulse_x = mass[0] * error_x + mass[1] * error_y
+            impulse_y = mass[1] * error_x + mass[2] * error_y
+            self._pivot_impulses[joint, 0] += impulse_x
+            self._pivot_impulses[joint, 1] += impulse_y
+            self._apply_pivot_impulse(leg, offsets, impulse_x, impulse_y)
+
+            max_impulse = model.max_torque[joint] * dt
+            relative_rate = angular_velocity[CENTER] - angular_velocity[leg] + self.rates[joint]
+            moment = 1.0 / (model.moment_inverse[leg] + model.moment_inverse[CENTER])
+            previous = self._motor_impulses[joint]
+            accumulated = np.clip(previous - relative_rate * moment, -max_impulse, max_impulse)
+            self._apply_motor_impulse(leg, accumulated - previous)
+            self._motor_impulses[joint] = accumulated
+
+    def bounding_boxes(self):
+        """left, bottom, right and top of every polygon, each of shape (3, size)"""
+        return (self.vertices_x.min(axis=1), self.vertices_y.min(axis=1),
+                self.vertices_x.max(axis=1), self.vertices_y.max(axis=1))
+
+    def calculate_overlap(self, active: np.ndarray = None) -> None:
+        """Adds the overlap of every polygon with the obstacle, like Universe.calculate_overlap"""
+        box_left, box_bottom, box_right, box_top = self.bounding_boxes()
+        x, y = self.obstacle_position
+        radius = self.obstacle_radius
+        left, bottom, right, top = x - radius, y - radius, x + radius, y + radius
+        intersects = (box_left <= right) & (left <= box_right) & (box_bottom <= top) & (bottom <= box_top)
+        overlap = np.maximum(box_left, left) - np.minimum(box_top, top)
+        overlap = np.where(intersects, overlap, 0.0).sum(axis=0)
+        if active is not None:
+            overlap = np.where(active, overlap, 0.0)
+        self.scores += overlap
+
+    def distance(self) -> np.ndarray:
+        """Distance between the center polygon and the finish, like Universe.distance"""
+        box_left, _, box_right, _ = self.bounding_boxes()
+        center = (0.5 * box_left[CENTER] + 0.5 * box_right[CENTER]).astype(int)  # int_tuple truncates
+        return self.finish_position - center
+
+    def calculate_distance(self, active: np.ndarray = None) -> None:
+        distance = self.distance()
+        if active is not None:
+            distance = np.where(active, distance, 0)
+        self.scores += distance
+
+    def get_pose(self) -> np.ndarray:
+        """x, y and angle of the polygons and the obstacle, shape (size, 4, 3), see Universe.get_pose"""
+        pose = np.empty((self.size, 4, 3))
+        pose[:, :3, 0] = self.x[:3].T
+        pose[:, :3, 1] = self.y[:3].T
+        pose[:, :3, 2] = self.angle[:3].T
+        pose[:, 3, :2] = self.obstacle_position
+        pose[:, 3, 2] = self.obstacle_angle
+        return pose
+
+
+class VectorSimulation:
+    """Simulates a whole population in a VectorUniverse, same timing and scoring rules as Simulation
+
+    All action lists must have the same length.
+    """
+    def __init__(
+            self,
+            population_actions: Sequence[Sequence[int]],
+            figure: Figure,
+            runtime: float = 10,  # in seconds
+            fps: float = 1.0 / 30,  # 30 frames per second
+            iterations: int = 10
+    ):
+
+        self.actions = np.array([[int(action) for action in actions] for actions in population_actions])
+        self.universe = VectorUniverse(figure, len(self.actions), iterations)
+        self.num_actions_per_second = runtime / self.actions.shape[1]
+        self.runtime = runtime
+        self.fps = fps
+        self.steps = 0
+        self.scores: List[float] = None
+        self.trajectories: List[Trajectory] = None  # set by run(record=True)
+
+    def run(self, record: bool = False) -> None:
+        universe = self.universe
+        # all lists have the same length and therefore the same timing
+        schedule = ActionSchedule(self.actions[0], self.runtime, self.fps)
+        frames = [universe.get_pose()] if record else None
+
+        while self.steps < schedule.num_steps:
+            universe.step(self.fps)
+            self.steps += 1
+            if record:
+                frames.append(universe.get_pose())
+
+            index = schedule.actions_at[self.steps]
+            if index is not None:
+                universe.apply_actions(self.actions[:, index])
+                universe.calculate_overlap()
+
+        universe.calculate_distance()
+        self.scores = [float(score) for score in universe.scores]
+        if record:
+            frames = np.stack(frames, axis=1).astype(np.float32)
+            self.trajectories = [Trajectory(frames[index], self.fps, score) for index, score in enumerate(self.scores)]
+
+    def evaluate(self) -> List[float]:
+        return self.scores
+
+
+class ValidationResult:
+    """Comparison of one action list simulated by pymunk and by the NumPy backend"""
+    def __init__(self, deviation: np.ndarray, tolerance: float, pymunk_score: float, numpy_score: float):
+        self.deviation = deviation  # largest body position difference after every step
+        self.pymunk_score = pymunk_score
+        self.numpy_score = numpy_score
+        exceeded = np.nonzero(deviation > tolerance)[0]
+        self.steps_within_tolerance = int(exceeded[0]) if len(exceeded) else len(deviation)
+
+    @property
+    def max_deviation(self) -> float:
+        return float(self.deviation.max())
+
+
+def validate(
+        figure: Figure,
+        population_actions: Sequence[Sequence[int]],
+        runtime: float = 10,
+        fps: float = 1.0 / 30,
+        tolerance: float = 1.0,  # largest accepted position difference of a body, in pixels
+        steps: int = None  # compared steps, defaults to the whole simulation
+) -> List[ValidationResult]:
+    """Simulates every action list with pymunk and with the NumPy backend and compares the trajectories
+
+    The walker is chaotic and both solvers differ in how they find contacts,
+    so trajectories drift apart eventually; the results tell for how many
+    steps every trajectory stays within the tolerance.
+    """
+    simulation = VectorSimulation(population_actions, figure, runtime, fps)
+    simulation.run(record=True)
+    results = []
+    for actions, trajectory, score in zip(population_actions, simulation.trajectories, simulation.scores):
+        reference = Simulation(list(actions), None, runtime, fps, universe=Universe(copy.deepcopy(figure)))
+        reference.run(record=True)
+        length = min(len(reference.trajectory), len(trajectory))
+        if steps is not None:
+            length = min(length, steps + 1)
+        difference = reference.trajectory.frames[1:length, :3, :2] - trajectory.frames[1:length, :3, :2]
+        deviation = np.linalg.norm(difference, axis=-1).max(axis=-1)
+        results.append(ValidationResult(deviation, tolerance, reference.evaluate(), score))
+    return results
+
+
+# compares the backends on random action lists
+if __name__ == '__main__':
+    import random
+    validation_runtime = 18
+    validation_moves_per_second = 3
+    validation_size = 20
+    random.seed(0)
+    population = [[random.randint(0, 3) for _ in range(validation_runtime * validation_moves_per_second)]
+                  for _ in range(validation_size)]
+    for result in validate(Figure(), population, validation_runtime, tolerance=1.0):
+        print('steps within 1px: {:4d}, max deviation: {:8.2f}, score pymunk: {:7.1f}, numpy: {:7.1f}'.format(
+            result.steps_within_tolerance, result.max_deviation, result.pymunk_score, result.numpy_score))